@@ -7,29 +7,88 @@ import irc.client
 from optparse import OptionParser
 import configparser
 import queue
-import random
+import socket
+import struct
 import threading
 import os, sys
-import io
 import string
 from unidecode import unidecode
 import collapse.collapseCore as collapseCore
+from collapse.workerPool import WorkerPool, PoolFull
 try:
-    import inotify.adapters
+    import inotify.calls
+    import inotify.constants
     INOTIFY_PRESENT = True
 except AttributeError:
     INOTIFY_PRESENT = False
 
+BRAIN_BACKENDS = ('flat', 'journal', 'sqlite')
+# how many reads of the inotify fd to do per wakeup before letting the
+# reactor get back to irc
+INOTIFY_BATCH = 64
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+INOTIFY_HEADER = struct.Struct('iIII')
+INOTIFY_READ_BYTES = 65536
+
+
+def parse_inotify_events(data):
+    """split what a read of an inotify fd returned into events
+    
+    Args:
+        data (bytes): whole inotify_event structs, as the kernel hands them
+    
+    Returns:
+        list: (watch descriptor, mask, filename) tuples
+    """
+    events = []
+    offset = 0
+    while offset + INOTIFY_HEADER.size <= len(data):
+        wd, mask, _, length = INOTIFY_HEADER.unpack_from(data, offset)
+        offset += INOTIFY_HEADER.size
+        name = data[offset:offset + length].rstrip(b'\0')
+        offset += length
+        events.append((wd, mask, name.decode('utf-8', 'replace')))
+    return events
+
 
 class CollapseReactor(irc.client.Reactor):
 
     def __init__(self, *args, **kwargs):
         self.process_callbacks = []
+        self.readers = {}
         irc.client.Reactor.__init__(self, *args, **kwargs)
 
     def add_process_callback(self, cb):
         self.process_callbacks.append(cb)
 
+    def add_reader(self, fileobj, cb):
+        """watch something besides the irc connections in the select loop
+        
+        Args:
+            fileobj (object): anything select() takes, a socket or an fd
+            cb (callable): called with no arguments when it's readable
+        """
+        with self.mutex:
+            self.readers[fileobj] = cb
+
+    def remove_reader(self, fileobj):
+        with self.mutex:
+            self.readers.pop(fileobj, None)
+
+    @property
+    def sockets(self):
+        with self.mutex:
+            return irc.client.Reactor.sockets.fget(self) + list(self.readers)
+
+    def process_data(self, sockets):
+        readers = [s for s in sockets if s in self.readers]
+        irc.client.Reactor.process_data(self,
+            [s for s in sockets if s not in self.readers])
+        for s in readers:
+            cb = self.readers.get(s)
+            if cb is not None:
+                cb()
+
     def process_once(self, timeout=0):
         irc.client.Reactor.process_once(self, timeout=timeout)
         for cb in self.process_callbacks:
@@ -46,21 +105,18 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
         collapse (Collapse): The collapseCore singleton
         collapse_thread (Thread): the main thread
         debug (bool): Should we print stuff out
-        inotify (Inotify): Inotify
-        inotify_generator (event_gen): event_gen
+        inotify_dirs (dict): watch descriptor -> watched directory
+        inotify_fd (int): the inotify instance, watched by the reactor
+        inotify_max_bytes (int): most of a dropped file that gets read
         log (dict): internal log of channels
+        pool (WorkerPool): runs callbacks off the reactor thread
         queue (Queue): Timed events ran in the background
         reactor_class (CollapseReactor): internal irc lib stuff
-        scheduled (bool): Make sure the queue is always depleting
         settings (dict): settings from conf file
-        threads (list): list of Threads
         useThreads (bool): use a thread?
     """
     
     reactor_class = CollapseReactor
-    queue = queue.Queue()
-    threads = []
-    callbacks = {}
 
     def __init__(self, settings):
         if 'port' not in settings:
@@ -71,20 +127,35 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
         self.settings = settings
         self.useThreads = 'use_threads' not in settings or \
             settings['use_threads']
+        self.callbacks = {}
+        self.queue = queue.Queue()
+        self.pool = None
+        if self.useThreads:
+            self.pool = WorkerPool(int(settings.get('worker_threads', 4)),
+                int(settings.get('worker_queue', 64)))
 
         irc.bot.SingleServerIRCBot.__init__(self, [(settings['server'], port)],
             settings['nick'], settings['user'])
 
         self.channel = settings['channel']
-        self.scheduled = False
-        self.schedule_cycle(0)
+        # workers poke this socketpair when a result is queued, which wakes
+        # the reactor's select() right away
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.connection.reactor.add_reader(self._wakeup_r,
+            self._dispatch_results)
         self.log = {}
+        self.debug = False
         if 'debug' in settings:
             print("debug mode on")
             self.debug = True
+        self.sweep_interval = float(settings.get('sweep_interval', 5))
 
         self._collapse_lock = threading.Lock()
         self._initialize_collapse()
+        self.connection.reactor.scheduler.execute_after(self.sweep_interval,
+            self._run_sweeper)
 
         if INOTIFY_PRESENT:
             inotify_dir = '/tmp/%s' % settings['nick']
@@ -95,11 +166,11 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
                 os.mkdir(reply_dir)
 
             print("Initializing inotify")
-            self.inotify = inotify.adapters.Inotify()
-            self.inotify.add_watch(inotify_dir)
-            self.inotify.add_watch(reply_dir)
-            self.inotify_generator = self.inotify.event_gen()
-            self._run_inotify()
+            self.inotify_max_bytes = int(settings.get('inotify_max_bytes',
+                65536))
+            self._watch_inotify([inotify_dir, reply_dir])
+            self.connection.reactor.add_reader(self.inotify_fd,
+                self._drain_inotify)
 
     def _initialize_collapse(self):
         def _c():
@@ -119,15 +190,17 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
         except Exception as e:
             result = e
         self.queue.put((tid, result))
-        if not self.scheduled:
-            self.schedule_cycle()
+        self._wakeup()
 
-    def _create_thread(self, target, func, args=[], kwargs={}):
-        tid = random.randint(0, 65535)
-        self.threads.append(threading.Thread(target=target,
-            args=[func, tid, args], kwargs=kwargs))
-        self.threads[-1].start()
-        return tid
+    def _wakeup(self):
+        """wake the reactor up to dispatch queued results
+        """
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # the buffer is full of wakeups the reactor hasn't read yet,
+            # so it's already going to look at the queue
+            pass
 
     def say(self, connection, target, message):
         """say something on irc
@@ -150,68 +223,160 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
             kwargs (dict, optional): Description
         """
         if self.useThreads:
-            tid = self._create_thread(self._handle_callback, func, args, kwargs)
+            # register the callback before queueing, a fast task could
+            # otherwise finish before there's anything to hand its result to
+            tid = self.pool.next_id()
             self.callbacks[tid] = lambda replies: self._handle_messages(c, reply_to, replies)
+            # this runs on the reactor thread, so never wait for room: a full
+            # queue would stall PINGs and every other channel
+            try:
+                self.pool.submit(self._handle_callback, [func, tid, args],
+                    kwargs, block=False, tid=tid)
+            except PoolFull:
+                del self.callbacks[tid]
+                print("worker queue full, dropped %s for %s" % \
+                    (func.__name__, reply_to))
         else:
             try:
                 result = func(*args, **kwargs)
             except Exception as e:
                 result = e
             self._handle_messages(c, reply_to, result)
-            if not self.scheduled:
-                self.schedule_cycle()
 
-    def _run_inotify(self):
-        """looks for files from the streaming connection that twitter no longer supports,
-           so this doesn't work anymore anyway
+    def _watch_inotify(self, paths):
+        """open a non-blocking inotify fd watching directories for files
+           that are written or moved in
+        
+        Args:
+            paths (list): the directories
         """
-        try:    
-            event = next(self.inotify_generator)
-            if event is not None:
-                (_, type_names, path, filename) = event
-                fullpath = '%s/%s' % (path, filename)
-                if 'IN_CLOSE_WRITE' in type_names and os.path.exists(fullpath):
-                    o = io.open(fullpath, mode="r", encoding="utf-8")
-                    contents = o.read().split('\n')
-                    o.close()
-                    os.unlink(fullpath)
-                    if '_replies' not in fullpath:
-                        self._handle_messages(self.connection, self.channel,
-                            contents)
-                    else:
-                        # actual reply from twitter. filename is the id
-                        self._handle_messages(self.connection,
-                            self.channel, self.collapse.process_tweet(filename))
-
-        except UnicodeDecodeError as e:
-            print(e)
-        self.connection.reactor.scheduler.execute_after(0.5,
-            self._run_inotify)
-
-    def _timed_events(self):
-        """Process timed events in plugins, and thread callbacks."""
-        # print 'Processing events'
-        try:
-            result = self.queue.get(False)
-            while len(result) > 0 and result[0] in list(self.callbacks.keys()):
-                # print 'queue contents' + repr(result)
-                self.callbacks[result[0]](result[1])
-                del(self.callbacks[result[0]])
-        except queue.Empty:
-            self.scheduled = False
-            # print 'Queue emptied.'
+        self.inotify_fd = inotify.calls.inotify_init()
+        os.set_blocking(self.inotify_fd, False)
+        mask = inotify.constants.IN_CLOSE_WRITE | \
+            inotify.constants.IN_MOVED_TO
+        self.inotify_dirs = {}
+        for path in paths:
+            wd = inotify.calls.inotify_add_watch(self.inotify_fd,
+                path.encode('utf-8'), mask)
+            self.inotify_dirs[wd] = path
+
+    def _drain_inotify(self):
+        """handle every inotify event that's ready, runs on the reactor
+           thread whenever the inotify fd is readable. the fd is
+           non-blocking, so this stops as soon as it's empty
+        """
+        for _ in range(INOTIFY_BATCH):
+            try:
+                data = os.read(self.inotify_fd, INOTIFY_READ_BYTES)
+            except BlockingIOError:
+                return
+            for (wd, mask, filename) in parse_inotify_events(data):
+                path = self.inotify_dirs.get(wd)
+                if path is not None and filename:
+                    self._inotify_event(mask, path, filename)
+
+    def _inotify_event(self, mask, path, filename):
+        """hand a file dropped in one of the watched directories to the
+           workers
+        
+        Args:
+            mask (int): inotify event bits
+            path (str): the watched directory
+            filename (str): the file
+        """
+        if not mask & (inotify.constants.IN_CLOSE_WRITE |
+                inotify.constants.IN_MOVED_TO):
             return
-        self.schedule_cycle()
+        fullpath = '%s/%s' % (path, filename)
+        if '_replies' not in fullpath:
+            self.set_callback(self.connection, self.channel,
+                self._read_dropped, args=[fullpath])
+        else:
+            # actual reply from twitter. filename is the id
+            self.set_callback(self.connection, self.channel,
+                self._read_reply, args=[fullpath, filename])
 
-    def schedule_cycle(self, delay=0.001):
-        """fire off the timed events
+    def _read_dropped(self, fullpath):
+        """read and remove a file of lines to say
+        
+        Args:
+            fullpath (str): the file
+        
+        Returns:
+            list: lines
+        """
+        try:
+            with open(fullpath, 'rb') as o:
+                contents = o.read(self.inotify_max_bytes)
+            os.unlink(fullpath)
+        except (IOError, OSError):
+            # gone already, someone else picked it up
+            return []
+        return contents.decode('utf-8', 'replace').split('\n')
+
+    def _read_reply(self, fullpath, tweet_id):
+        """remove a reply file and fetch the tweet it names
         
         Args:
-            delay (float, optional): how long to wait
+            fullpath (str): the file
+            tweet_id (str): the tweet id
+        
+        Returns:
+            list: lines
+        """
+        try:
+            os.unlink(fullpath)
+        except OSError:
+            return []
+        return self.collapse.process_tweet(tweet_id)
+
+    def _run_sweeper(self):
+        """every sweep_interval, have the worker pool expire a few buckets'
+           worth of old cache entries from the brain. sweeping reads and
+           rewrites bucket files, which mustn't hold up the reactor
         """
-        self.connection.reactor.scheduler.execute_after(delay,
-            self._timed_events)
-        self.scheduled = True
+        if self.pool is None:
+            self._sweep()
+        else:
+            try:
+                self.pool.submit(self._sweep, block=False)
+            except (PoolFull, RuntimeError):
+                # busy (or shutting down), the next round will catch up
+                pass
+        self.connection.reactor.scheduler.execute_after(self.sweep_interval,
+            self._run_sweeper)
+
+    def _sweep(self):
+        """expire a few buckets' worth of old cache entries from the brain.
+           skipped if a sweep is already running or the brain isn't open
+        """
+        if getattr(self, 'collapse', None) is not None and \
+                self._collapse_lock.acquire(False):
+            try:
+                entries, size = self.collapse.brain.sweep()
+                if entries and self.debug:
+                    print("expired %d brain entries (%d bytes)" % \
+                        (entries, size))
+            finally:
+                self._collapse_lock.release()
+
+    def _dispatch_results(self):
+        """Hand finished callbacks' results over, runs on the reactor thread
+           whenever the wakeup socket is readable
+        """
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while True:
+            try:
+                tid, result = self.queue.get(False)
+            except queue.Empty:
+                return
+            callback = self.callbacks.pop(tid, None)
+            if callback is not None:
+                callback(result)
 
     def _log(self, channel, nick, message):
         """logs message from users
@@ -288,10 +453,7 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
                 print("oops some unicode", end=' ')
         if not self.collapse.nick_ignored(e.source.nick):
             self._command_check(c, e, e.target)
-            def _noop(func, tid, args, **kwargs):
-                pass
-            self._create_thread(_noop, self._log,
-                [e.target, e.source.nick, e.arguments[0]])
+            self._log(e.target, e.source.nick, e.arguments[0])
 
     def _handle_messages(self, c, reply_to, replies):
         """main message handler for bot
@@ -334,12 +496,6 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
             elif reply is not None:
                 print(repr(reply))
 
-    def _wait_for_all_threads(self):
-        """wait
-        """
-        for thread in self.threads:
-            thread.join()
-
     def _command_check(self, c, e, reply_to):
         """Process commands that have corresponding methods.
         
@@ -362,11 +518,14 @@ class CollapseBot(irc.bot.SingleServerIRCBot):
 
         cmds = arg.split(' ')
         self.set_callback(c, reply_to, self.collapse.said, args=[e.source.nick, arg])
-        self.set_callback(c, reply_to, self.collapse.handle_command, args=[sender, arg, reply_to])
+        self.set_callback(c, reply_to, self.collapse.handle_command, args=[sender, arg])
 
     def stop_tweepy(self):
-        """kill tweepy
+        """kill tweepy, let queued callbacks finish, and flush anything the
+           brain hasn't written yet
         """
+        if self.pool is not None:
+            self.pool.shutdown()
         self._collapse_lock.acquire()
         self.collapse.stop_tweepy()
         self._collapse_lock.release()
@@ -385,11 +544,14 @@ def load_settings(filename):
     config = configparser.ConfigParser()
     config.read(filename)
     for option in config.options("bot"):
-        if option in ['expand_urls', 'use_threads']:
+        if option in ['expand_urls', 'use_threads', 'write_behind']:
             settings[option] = config.getboolean('bot', option)
         else:
             settings[option] = config.get("bot", option)
 
+    if settings.get('brain_backend', 'flat') not in BRAIN_BACKENDS:
+        raise ValueError('brain_backend must be one of: %s' % \
+            ', '.join(BRAIN_BACKENDS))
     if 'banned_urls' not in settings:
         settings['banned_urls'] = []
     settings['filename'] = filename
@@ -399,6 +561,8 @@ def main():
     """main entrypoint
     """
     parser = OptionParser()
+    parser.add_option('--rebuild-bloom', action='store_true', default=False,
+        help='rebuild the brain\'s Bloom filters from a full scan and exit')
 
     (options, args) = parser.parse_args()
 
@@ -408,6 +572,12 @@ def main():
 
     settings = load_settings(args[0])
 
+    if options.rebuild_bloom:
+        brain = collapseCore.open_brain(settings)
+        brain.rebuild_bloom()
+        brain.close()
+        return
+
     bot = CollapseBot(settings)
     try:
         bot.start()
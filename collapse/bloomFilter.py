@@ -0,0 +1,219 @@
+import os
+import math
+import struct
+import hashlib
+import threading
+
+HEADER = struct.Struct('<4sQdQQ')
+MAGIC = b'CBF1'
+
+
+class BloomFilter(object):
+    """A plain Bloom filter over string keys. Answers "definitely not added"
+    or "maybe added", with the false positive rate it was sized for as long
+    as it holds no more than capacity keys.
+
+    Attributes:
+        bits (bytearray): the bit array
+        capacity (int): how many keys it was sized for
+        count (int): how many keys were added
+        error_rate (float): target false positive rate
+        hashes (int): bits set per key
+        size (int): number of bits
+    """
+
+    def __init__(self, capacity=500000, error_rate=0.01):
+        """constructor
+
+        Args:
+            capacity (int, optional): how many keys to size for
+            error_rate (float, optional): target false positive rate
+        """
+        self.capacity = int(capacity)
+        self.error_rate = float(error_rate)
+        self.size = max(8, int(math.ceil(
+            -self.capacity * math.log(self.error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        """Add a key
+
+        Args:
+            key (str): key!
+        """
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def save(self, path):
+        """Write the filter to a file, atomically
+
+        Args:
+            path (str): where to write it
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, self.capacity, self.error_rate,
+                self.hashes, self.count))
+            out.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a filter written by save()
+
+        Args:
+            path (str): where it was written
+
+        Returns:
+            BloomFilter: the filter, or None if the file isn't one
+        """
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) != HEADER.size:
+                return None
+            magic, capacity, error_rate, hashes, count = HEADER.unpack(header)
+            if magic != MAGIC:
+                return None
+            bloom = cls(capacity, error_rate)
+            bits = f.read()
+        if hashes != bloom.hashes or len(bits) != len(bloom.bits):
+            return None
+        bloom.bits = bytearray(bits)
+        bloom.count = count
+        return bloom
+
+
+class BloomIndex(object):
+    """Bloom filters for a few brain namespaces, kept next to the brain so a
+    restart doesn't have to rebuild them. A filter file is removed once it's
+    loaded and only written back by a clean save(), so a crash can't leave a
+    filter behind that's missing keys; that namespace is rebuilt from a
+    brain scan instead. Until a namespace's filter is ready every lookup in
+    it falls through to the brain.
+
+    Attributes:
+        capacity (int): keys each filter is sized for
+        directory (str): where filter files live
+        error_rate (float): target false positive rate
+        filters (dict): namespace -> BloomFilter, for ready namespaces
+        namespaces (list): the filtered namespaces
+        skipped (int): lookups answered without touching the brain
+    """
+
+    def __init__(self, directory, namespaces, capacity=500000, error_rate=0.01):
+        """constructor
+
+        Args:
+            directory (str): where filter files live
+            namespaces (list): namespaces to filter
+            capacity (int, optional): keys each filter is sized for
+            error_rate (float, optional): target false positive rate
+        """
+        self.directory = directory
+        self.namespaces = list(namespaces)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = {}
+        self.skipped = 0
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def _path(self, namespace):
+        return os.path.join(self.directory, '%s.bloom' % namespace)
+
+    def load(self):
+        """Load every saved filter that still matches the configured sizing
+
+        Returns:
+            list: namespaces that have no usable filter and need a rebuild
+        """
+        stale = []
+        for namespace in self.namespaces:
+            path = self._path(namespace)
+            bloom = None
+            if os.path.exists(path):
+                bloom = BloomFilter.load(path)
+                os.unlink(path)
+            if bloom is None or bloom.capacity != self.capacity or \
+                    bloom.error_rate != self.error_rate:
+                stale.append(namespace)
+            else:
+                self.filters[namespace] = bloom
+        return stale
+
+    def save(self):
+        """Write every ready filter next to the brain"""
+        with self._lock:
+            filters = list(self.filters.items())
+        for namespace, bloom in filters:
+            bloom.save(self._path(namespace))
+
+    def rebuild(self, brain, namespaces=None):
+        """Build filters from a brain scan. Keys added while the scan runs
+        go into the new filter too.
+
+        Args:
+            brain (NamespacedBrain): the brain to scan
+            namespaces (list, optional): which namespaces, defaults to all
+        """
+        for namespace in namespaces or self.namespaces:
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            with self._lock:
+                self._building[namespace] = bloom
+            for key, _ in brain.scan(namespace + '_'):
+                bloom.add(key)
+            with self._lock:
+                self.filters[namespace] = bloom
+                del self._building[namespace]
+
+    def rebuilding(self):
+        """Namespaces with a rebuild in progress
+
+        Returns:
+            list: namespaces
+        """
+        with self._lock:
+            return sorted(self._building)
+
+    def might_contain(self, key):
+        """Could the brain have this key?
+
+        Args:
+            key (str): key!
+
+        Returns:
+            bool: False if it's definitely not stored
+        """
+        bloom = self.filters.get(key.split('_')[0])
+        if bloom is None or key in bloom:
+            return True
+        self.skipped += 1
+        return False
+
+    def add(self, key):
+        """Record a key being stored
+
+        Args:
+            key (str): key!
+        """
+        namespace = key.split('_')[0]
+        with self._lock:
+            for filters in (self.filters, self._building):
+                if namespace in filters:
+                    filters[namespace].add(key)
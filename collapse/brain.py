@@ -1,6 +1,6 @@
 import json
 import os
-import collections
+from collapse.lruCache import LRUCache, MISSING
 
 class Brain(dict):
 
@@ -14,7 +14,10 @@ class Brain(dict):
             os.mkdir(self.braindir)
         self.useCache = 'cache' in kwargs and kwargs['cache']
         if self.useCache:
-            self.cache = collections.OrderedDict()
+            self.cache = LRUCache(
+                max_entries=kwargs.get('cache_entries', 50),
+                max_bytes=kwargs.get('cache_bytes'),
+                namespace_limits=kwargs.get('cache_limits'))
 
     def _keyPrefix(self, key):
         if '_' in key:
@@ -30,14 +33,14 @@ class Brain(dict):
         return os.path.join(self.braindir, self._keyPrefix(key), key)
 
     def cacheItem(self, key, val):
-        self.cache[key] = val
-        if len(self.cache) > 50:
-            self.cache.pop(list(self.cache.keys())[-1], None)        
+        self.cache.put(key, val)
 
     def __getitem__(self, key):
         # print 'getting %s' % key
-        if self.useCache and key in self.cache:
-            return self.cache[key]
+        if self.useCache:
+            val = self.cache.get(key)
+            if val is not MISSING:
+                return val
         fn = self._keyPath(key)
         if not os.path.exists(fn):
             raise KeyError('Key not found')
@@ -55,5 +58,7 @@ class Brain(dict):
             self.cacheItem(key, val)
 
     def __contains__(self, key):
-        return (self.useCache and key in self.cache) or os.path.exists(self._keyPath(key))
+        if self.useCache and self.cache.get(key) is not MISSING:
+            return True
+        return os.path.exists(self._keyPath(key))
 
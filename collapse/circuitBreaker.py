@@ -0,0 +1,100 @@
+import threading
+import time
+import requests.exceptions
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of making a request to a host whose circuit is open.
+    It's a ConnectionError so callers' existing handling covers it."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Tracks one host's recent failures. After failure_threshold failures
+    in a row the circuit opens and requests are refused without touching
+    the network for open_seconds. After that a single probe request is let
+    through (half-open); if it works the circuit closes, otherwise it opens
+    again for another open_seconds.
+
+    Attributes:
+        failure_threshold (int): failures in a row that open the circuit
+        failures (int): failures in a row so far
+        open_seconds (float): how long the circuit stays open
+        opened_at (float): when it last opened
+        rejected (int): requests refused while open
+        state (str): CLOSED, OPEN or HALF_OPEN
+    """
+
+    def __init__(self, failure_threshold=5, open_seconds=30):
+        """constructor
+
+        Args:
+            failure_threshold (int, optional): failures in a row that open
+                the circuit
+            open_seconds (float, optional): how long it stays open
+        """
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """May a request go out now? Letting one through while half-open
+        makes it the probe, and the caller must report how it went.
+
+        Returns:
+            bool: yep
+        """
+        with self._lock:
+            if self.state == OPEN and \
+                    time.time() - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        """Report a request that worked"""
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def failure(self):
+        """Report a request that failed"""
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
+            self._probing = False
+
+    def release(self):
+        """Report a request that didn't say anything about the host, like
+        one that was cancelled or had a bad URL. If it was the probe, the
+        next request gets to be one instead."""
+        with self._lock:
+            self._probing = False
+
+    def remaining(self):
+        """Seconds until an open circuit lets a probe through
+
+        Returns:
+            float: seconds, 0 unless it's open
+        """
+        if self.state != OPEN:
+            return 0
+        return max(0, self.open_seconds - (time.time() - self.opened_at))
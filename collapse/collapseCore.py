@@ -13,36 +13,111 @@ import hashlib
 import string
 import shelve
 from html.parser import HTMLParser
-from collapse.expandurl import ExpandURL, make_result
+from collapse.expandurl import ExpandURL, make_result, SHORTENERS
 from babel.dates import format_timedelta
 from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+import contextlib
 import random
 import logging
 from collapse.namespacedBrain import NamespacedBrain
+from collapse.journaledBrain import JournaledBrain
+from collapse.sqliteBrain import SqliteBrain
 from collapse.imagegetter import ImageGetter
+from collapse.httpClient import HTTPClient
+from collapse.mediaCache import MediaCache
+from collapse.tweetHydrator import TweetHydrator
+from collapse.twitterScheduler import TwitterScheduler, Throttled
 import requests
 import requests.exceptions
 import re
 import textwrap
 import traceback
 
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_duration(value):
+    """turn a conf file duration like 90, 30m or 7d into seconds
+    
+    Args:
+        value (str): the duration
+    
+    Returns:
+        float: seconds
+    """
+    value = str(value).strip().lower()
+    if value[-1:] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
+
+def open_brain(settings):
+    """open the brain with the storage backend picked in the conf file
+    
+    Args:
+        settings (dict): a dict of settings from the conf file
+    
+    Returns:
+        NamespacedBrain: the brain
+    """
+    backend = settings.get('brain_backend', 'flat')
+    cache_limits = dict(
+        (option[len('cache_limit_'):], int(value))
+        for option, value in settings.items()
+        if option.startswith('cache_limit_'))
+    ttls = dict(
+        (option[len('ttl_'):], parse_duration(value))
+        for option, value in settings.items()
+        if option.startswith('ttl_'))
+    cache_bytes = settings.get('cache_bytes')
+    options = {
+        'cache': True,
+        'cache_entries': int(settings.get('cache_entries', 1000)),
+        'cache_bytes': int(cache_bytes) if cache_bytes else None,
+        'cache_limits': cache_limits,
+        'bucket_cache': int(settings.get('bucket_cache', 256)),
+        'ttls': ttls,
+        'bloom_namespaces': settings.get('bloom_namespaces',
+            'urls expanded tweet toot').split(),
+        'bloom_capacity': int(settings.get('bloom_capacity', 500000)),
+        'bloom_error': float(settings.get('bloom_error', 0.01))
+    }
+    if backend == 'sqlite':
+        return SqliteBrain(path=settings.get('brain_path'), **options)
+    if backend == 'journal':
+        return JournaledBrain(compact_bytes=int(
+            settings.get('journal_compact_bytes', 65536)), **options)
+    return NamespacedBrain(
+        write_behind=settings.get('write_behind', False),
+        flush_interval=float(settings.get('flush_interval', 1.0)),
+        **options)
+
 class Collapse(object):
     """Core bot functionality, mostly separate from the IRC functionality
     
     Attributes:
         brain (Brain): Brain instance
         brain_lock (Lock): The lock used during writes to the brain
-        collapse_api (tweepy.API): Tweepy instance
+        key_locks (list): striped locks for read-modify-write brain updates
+        collapse_api (TwitterScheduler): Tweepy instance, behind the rate
+            limit scheduler
         collapse_auth (tweepy.OAuthHandler): Tweepy auth object
+        expand_deadline (float): seconds a message waits for url expansions
+        expand_late (int): expansions that missed the deadline
         expand_urls (bool): Whether we should expand shorturls
         expandedURLs (dict): The dict of expanded urls so we don't spam HTTP requests
         expandURL (ExpandURL): ExpandURL instance
+        http (HTTPClient): shared client for every outbound HTTP request
+        hydrator (TweetHydrator): batches tweet lookups
         image_getter (ImageGetter): ImageGetter instance
         insults (list): a list of colorful adjectives 
         me (object): tweepy me()
+        media_reuse (float): seconds an uploaded media id can be used again
+        media_reused (int): images that didn't need uploading again
         settings (dict): a dict of settings retrieved from the conf file
         status_callbacks (list): A list of callbacks to execute
         twitter_timeout (int): timeout used for twitter actions
+        url_pool (ThreadPoolExecutor): fetches the tweets and toots linked
+            in a message at once
     """
     
     def __init__(self, settings):
@@ -52,12 +127,13 @@ class Collapse(object):
             settings (dict): a dict of settings from the conf file
         """
         self.brain_lock = Lock()
+        self.key_locks = [Lock() for _ in range(64)]
         insult_data = json.load(
             open(os.path.join(os.path.dirname(__file__), 'insults.json'), 'r'))
         if 'insults' in insult_data:
             self.insults = insult_data['insults']
-        self.brain = NamespacedBrain()
         self.settings = settings
+        self.brain = self._open_brain()
         self.collapse_auth = tweepy.OAuthHandler(
             settings['consumer_key'],
             settings['consumer_secret']
@@ -69,10 +145,53 @@ class Collapse(object):
         self.status_callbacks = []
         self.expand_urls = 'expand_urls' in self.settings and \
             self.settings['expand_urls']
-        self.image_getter = ImageGetter()
-        self.expandURL = ExpandURL()
+        self.http = HTTPClient(
+            max_workers=int(settings.get('http_workers', 8)),
+            per_host=int(settings.get('http_per_host', 2)),
+            pool_size=int(settings.get('http_pool_size', 8)),
+            connect_timeout=float(settings.get('http_connect_timeout', 3.05)),
+            read_timeout=float(settings.get('http_read_timeout', 5)),
+            failure_threshold=int(settings.get('http_failure_threshold', 5)),
+            open_seconds=parse_duration(settings.get('http_open_time', '30s')))
+        media_cache_bytes = int(settings.get('media_cache_bytes',
+            256 * 1024 * 1024))
+        self.image_getter = ImageGetter(http=self.http,
+            timeout=float(settings.get('image_timeout', 1.5)),
+            workers=int(settings.get('image_workers', 4)),
+            spool_bytes=int(settings.get('image_spool_bytes', 1024 * 1024)),
+            cache=MediaCache(settings.get('media_cache_dir',
+                    os.path.join(os.path.expanduser('~'), '.collapseMedia')),
+                self.brain, media_cache_bytes) if media_cache_bytes else None)
+        self.media_reuse = parse_duration(settings.get('media_reuse', '23h'))
+        self.media_reused = 0
+        self.expandURL = ExpandURL(brain=self.brain,
+            negative_ttl=parse_duration(
+                self.settings.get('expand_negative_ttl', '5m')),
+            http=self.http,
+            shorteners=self.settings.get('shorteners',
+                ' '.join(SHORTENERS)).split(),
+            learn_after=int(self.settings.get('expand_learn_after', 3)))
+        self.expand_deadline = float(
+            self.settings.get('expand_deadline_ms', 400)) / 1000
+        self.expand_late = 0
+        self.hydrator = TweetHydrator(self._lookup_tweets,
+            window=float(settings.get('tweet_batch_ms', 50)) / 1000)
+        self.url_pool = ThreadPoolExecutor(
+            max_workers=int(settings.get('url_workers', 4)))
         self.expandedURLs = {}
 
+    def _open_brain(self):
+        """open the brain with the storage backend picked in the conf file,
+           rebuilding any Bloom filters that weren't saved in the background
+        
+        Returns:
+            NamespacedBrain: the brain
+        """
+        brain = open_brain(self.settings)
+        if brain.bloom_stale:
+            brain.rebuild_bloom(brain.bloom_stale, background=True)
+        return brain
+
     def _start_twitter(self):
         try:
             self.lock()
@@ -91,7 +210,16 @@ class Collapse(object):
                 self.brain['collapse_access_token_key'] = access_token[0]
                 self.brain['collapse_access_token_secret'] = access_token[1]
                 self.unlock()
-            self.collapse_api = tweepy.API(self.collapse_auth, timeout=self.twitter_timeout)
+            self.collapse_api = TwitterScheduler(
+                tweepy.API(self.collapse_auth, timeout=self.twitter_timeout),
+                rate=float(self.settings.get('twitter_rate', 1)),
+                burst=int(self.settings.get('twitter_burst', 10)),
+                write_reserve=int(self.settings.get('twitter_write_reserve', 3)),
+                low_water=int(self.settings.get('twitter_low_water', 2)),
+                read_wait=parse_duration(
+                    self.settings.get('twitter_read_wait', '2s')),
+                write_wait=parse_duration(
+                    self.settings.get('twitter_write_wait', '10s')))
             self.me = self.collapse_api.me()
         except tweepy.error.TweepError as e:
             logging.exception(e)
@@ -102,6 +230,24 @@ class Collapse(object):
     def unlock(self):
         return self.brain_lock.release()
 
+    @contextlib.contextmanager
+    def key_lock(self, keys):
+        """hold the locks for some brain keys, so a read-modify-write of
+           those keys doesn't race with another message touching them. Keys
+           map onto a fixed set of striped locks, taken in order.
+        
+        Args:
+            keys (list): brain keys
+        """
+        stripes = sorted(set(hash(key) % len(self.key_locks) for key in keys))
+        for stripe in stripes:
+            self.key_locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self.key_locks[stripe].release()
+
     def handle_status_callbacks(self, status):
         """Summary
         
@@ -133,7 +279,10 @@ class Collapse(object):
         self.status_callbacks.append(func)
 
     def stop_tweepy(self):
-        pass
+        self.url_pool.shutdown()
+        self.image_getter.close()
+        self.http.close()
+        self.brain.close()
 
     def _brain_filter(self, key_prefix):
         """Returns a subset dict of stuff from the brain
@@ -144,8 +293,7 @@ class Collapse(object):
         Returns:
             dict: what you want
         """
-        keys_filtered = [k for k in self.brain if k[:len(key_prefix)] == key_prefix]
-        return dict([(k, self.brain[k]) for k in keys_filtered])
+        return dict(self.brain.scan(key_prefix))
 
     def get_url_futures(self, text):
         """open requests for all the urls from the text
@@ -157,17 +305,23 @@ class Collapse(object):
             list: list of futures
         """
         futures = []
+        urls = []
         parts = text.split(' ')
         for part in parts:
             part = ''.join([x for x in part if x in string.printable])
             if part.startswith('https://') or part.startswith('http://'):
-                brainkey = 'expanded_' + self._hexurl(part)
-                if brainkey not in self.brain:
-                    futures.append(self.expandURL.expand(part))
+                urls.append(part)
+        known = self.expandURL.cache.get_many(urls)
+        for url in urls:
+            if url not in known:
+                futures.append(self.expandURL.expand(url))
         return futures
 
     def expand_text_urls(self, text, futures):
-        """Expands short URLs in text if necessary
+        """Expands short URLs in text if necessary. Expansions get
+           expand_deadline between them to land; the ones that don't are left
+           to finish in the background and fill the cache, and their URLs fall
+           back to whatever the cache already knew, or stay as they are.
         
         Args:
             text (str): the text
@@ -193,16 +347,26 @@ class Collapse(object):
                     # if the shorter url is really shorter, append
                     # the domain name.
                     expanded[result['start_url']] = shorturl_domain_name            
+        futures = [future for future in futures if future]
+        wait([future.future for future in futures
+            if future.future is not None], timeout=self.expand_deadline)
+        landed = set()
         for future in futures:
-            result = future.finish()
-            get_expanded(result)      
+            if future.future is not None and not future.future.done():
+                self.expand_late += 1
+                continue
+            landed.add(future.startUrl)
+            get_expanded(future.finish())
+        unexpanded = []
         for part in parts:
             part = ''.join([x for x in part if x in string.printable])
             if (part.startswith('https://') or part.startswith('http://')) and \
-                part not in expanded:
-                key = 'expanded_' + self._hexurl(part)
-                if key in self.brain:
-                    get_expanded(make_result(part, self.brain[key]))
+                part not in landed:
+                unexpanded.append(part)
+        # get_url_futures already counted these lookups
+        known = self.expandURL.cache.get_many(unexpanded, count=False)
+        for part, entry in known.items():
+            get_expanded(make_result(part, entry['end_url']))
         for src_url in expanded:
             text = text.replace(src_url, expanded[src_url])
         return text
@@ -217,7 +381,7 @@ class Collapse(object):
             str: the sha1 hash of a URL
         """
         h = hashlib.sha1()
-        h.update(url)
+        h.update(url.encode('utf-8'))
         return h.hexdigest()
 
     def handle_command(self, sender, message):
@@ -302,9 +466,42 @@ class Collapse(object):
 
         except Exception as e:
             logging.exception(e)
-            self.unlock()
             raise e
 
+    def status(self):
+        """admin status report
+        
+        Returns:
+            list: list of str
+        """
+        cache = self.brain.cache.stats()
+        expansions = self.expandURL.cache.stats()
+        return [
+            'brain cache: %(hits)d hits, %(misses)d misses, '
+            '%(evictions)d evictions, %(entries)d entries, %(bytes)d bytes' % cache,
+            'expiry sweeper: %d entries, %d bytes reclaimed' % \
+                (self.brain.swept_entries, self.brain.swept_bytes),
+            'bloom filters: %d lookups skipped, rebuilding: %s' % \
+                (self.brain.bloom.skipped if self.brain.bloom else 0,
+                    ' '.join(self.brain.bloom.rebuilding()) or 'none'
+                    if self.brain.bloom else 'none'),
+            'url expansions: %(hits)d hits, %(negative_hits)d cached failures, '
+            '%(misses)d misses (%(stale)d stale), %(ratio).0f%% hit ratio, '
+            'mean age %(mean_age).0fs, %(saved)d fetches coalesced, '
+            '%(skipped)d skipped as non-redirecting, %(late)d late' % \
+                dict(expansions, ratio=expansions['ratio'] * 100,
+                    saved=self.expandURL.saved,
+                    skipped=self.expandURL.skipped, late=self.expand_late),
+            'circuit breakers: %s' % \
+                ('; '.join(self.http.breaker_status()) or 'all closed'),
+            'media cache: %(hits)d hits, %(misses)d misses, %(files)d files, '
+            '%(bytes)d bytes, %(evictions)d evictions, %(reused)d uploads '
+            'reused' % dict(self.image_getter.cache.stats()
+                if self.image_getter.cache else dict(hits=0, misses=0,
+                    files=0, bytes=0, evictions=0),
+                reused=self.media_reused)
+        ] + (self.collapse_api.status() if self.collapse_api else [])
+
     def is_owner(self, sender):
         """is the nick the owner?
         
@@ -502,20 +699,18 @@ class Collapse(object):
         Returns:
             str: return str
         """
-        self.lock()
         k = 'said_%s' % nick
-        if not self.nick_ignored(nick) and k in self.brain:
-            out = [self.brain[k]]
-            out.append(extra)
-            try:
-                self.collapse_api.update_status(status=' '.join(out))
-            except tweepy.TweepError as e:
-                self.unlock()
-                return str(e.message[0]['message'])
-            self.unlock()
-            return "%s has been quoted to Twitter." % nick
-        self.unlock()
-        return "Nothing found for %s" % nick
+        if self.nick_ignored(nick):
+            return "Nothing found for %s" % nick
+        try:
+            said = self.brain[k]
+        except KeyError:
+            return "Nothing found for %s" % nick
+        try:
+            self.collapse_api.update_status(status=' '.join([said, extra]))
+        except tweepy.TweepError as e:
+            return self._twitter_error(e)
+        return "%s has been quoted to Twitter." % nick
 
     def twit(self, message):
         """tweet something
@@ -527,14 +722,36 @@ class Collapse(object):
             bool: yes
         """
         try:
-            media_payload = self.image_getter.get_images(message)
-            media_ids = [self.collapse_api.media_upload(i).media_id_string for i in media_payload[1]]
-            self.collapse_api.update_status(status=media_payload[0], media_ids=media_ids)
+            status, media_ids = self.image_getter.get_images(message,
+                self._upload_media)
+            self.collapse_api.update_status(status=status, media_ids=media_ids)
         except tweepy.TweepError as e:
             logging.exception(e)
-            return e.message
+            return self._twitter_error(e)
         return True
 
+    def _upload_media(self, filename, digest, body=None):
+        """upload an image to twitter, unless the same image was uploaded
+           recently enough that twitter still has it
+        
+        Args:
+            filename (str): the image
+            digest (str): sha256 of the image
+            body (file, optional): read the image from here instead
+        
+        Returns:
+            str: its media id
+        """
+        key = 'media_' + digest
+        known = self.brain.get_many([key]).get(key)
+        if known is not None and time() - known['uploaded'] < self.media_reuse:
+            self.media_reused += 1
+            return known['media_id']
+        media_id = self.collapse_api.media_upload(filename,
+            file=body).media_id_string
+        self.brain[key] = {'media_id': media_id, 'uploaded': time()}
+        return media_id
+
     def untwit(self, id=None):
         """delete a tweet
         
@@ -554,7 +771,7 @@ class Collapse(object):
                 return "Destroyed status " + str(self.me.status.id) + ": " + \
                     self.me.status.text[:15] + '...'
         except tweepy.TweepError as e:
-            return e.message
+            return self._twitter_error(e)
 
     def syntax(self):
         """help
@@ -601,9 +818,9 @@ class Collapse(object):
                 self._log("Returning because this is a bogus command.")
                 return
 
-        media_payload = self.image_getter.get_images(text)
-        media_ids = [self.collapse_api.media_upload(i).media_id_string for i in media_payload[1]]
-        self.collapse_api.update_status(status=media_payload[0], media_ids=media_ids,
+        status, media_ids = self.image_getter.get_images(text,
+            self._upload_media)
+        self.collapse_api.update_status(status=status, media_ids=media_ids,
             in_reply_to_status_id=last_id)
 
     def expand_twitter_urls(self, status):
@@ -640,11 +857,13 @@ class Collapse(object):
         return re.sub(r'<[^>]+>', '',
             content.replace('</p>', '\n').replace('<br />', '\n')).strip()
 
-    def process_toot(self, toot_url):
+    def process_toot(self, toot_url, updates=None):
         """process mastodon posts for IRC
         
         Args:
             toot_url (str): url to toot
+            updates (dict, optional): put what should be saved in the brain
+                here instead of saving it
         
         Returns:
             str: the ircable body
@@ -665,7 +884,7 @@ class Collapse(object):
             if toot_url[-5:] != '.json':
                 toot_url += '.json'
             try:
-                r = requests.get(toot_url)
+                r = self.http.get(toot_url)
                 try:
                     resp = r.json()
                     content = self.render_html(resp['content'])
@@ -680,7 +899,10 @@ class Collapse(object):
                     content = content.replace('\-', '-')
                     formatted = self.ircify('%s' % toot_user,
                             content) #, emoji=u'🐘')
-                    self.brain[tootkey] = formatted
+                    if updates is None:
+                        self.brain[tootkey] = formatted
+                    else:
+                        updates[tootkey] = formatted
                     messages.extend(formatted)
                 except KeyError as e:
                     print(e)
@@ -693,6 +915,18 @@ class Collapse(object):
                 return messages
         return messages
 
+    def _lookup_tweets(self, tweet_ids):
+        """fetch up to 100 tweets in one call, for the hydrator
+        
+        Args:
+            tweet_ids (list): tweet ids
+        
+        Returns:
+            list: statuses, leaving out any that don't exist
+        """
+        return self.collapse_api.statuses_lookup(tweet_ids,
+            tweet_mode='extended')
+
     def process_tweet(self, tweet_id, via=None):
         """process tweet for IRC
         
@@ -703,26 +937,86 @@ class Collapse(object):
         Returns:
             list: list of str
         """
-        print('processing tweet id', tweet_id)
-        messages=[]
-        tweetkey = 'tweet_' + str(tweet_id)
-        if tweetkey in self.brain:
-            print('tweet in brain')
-            messages.extend(self.brain[tweetkey])
-        else:
+        return self.process_tweets([tweet_id], via=via)[tweet_id]
+
+    def process_tweets(self, tweet_ids, via=None, updates=None):
+        """process several tweets for IRC, fetching the ones that aren't in
+           the brain with one lookup. when twitter's rate limit is used up,
+           expired copies still in the brain are served instead
+        
+        Args:
+            tweet_ids (list): ids of tweets
+            via (None, optional): not used
+            updates (dict, optional): put what should be saved in the brain
+                here instead of saving it
+        
+        Returns:
+            dict: tweet id -> list of str
+        """
+        print('processing tweet ids', ' '.join(str(t) for t in tweet_ids))
+        tweetkeys = dict((tweet_id, 'tweet_' + str(tweet_id))
+            for tweet_id in tweet_ids)
+        known = self.brain.get_many(tweetkeys.values())
+        missing = [tweet_id for tweet_id in tweet_ids
+            if tweetkeys[tweet_id] not in known]
+        statuses = {}
+        failed = None
+        if missing:
+            try:
+                statuses = self.hydrator.fetch(missing)
+            except tweepy.TweepError as e:
+                failed = [self._twitter_error(e)]
+                if isinstance(e, Throttled):
+                    known.update(self.brain.get_many(
+                        [tweetkeys[tweet_id] for tweet_id in missing],
+                        stale=True))
+        results = {}
+        for tweet_id in tweet_ids:
+            tweetkey = tweetkeys[tweet_id]
+            if tweetkey in known:
+                results[tweet_id] = list(known[tweetkey])
+                continue
+            if failed is not None:
+                results[tweet_id] = failed
+                continue
             try:
-                status = self.collapse_api.get_status(id=tweet_id, tweet_mode='extended')
+                status = statuses.get(str(tweet_id))
+                if status is None:
+                    # not in the bulk lookup, ask for it by itself to get
+                    # twitter's reason why
+                    status = self.collapse_api.get_status(id=tweet_id,
+                        tweet_mode='extended')
                 user_key = 'twitter_user_%s_last_id' % \
                     status.user.screen_name.lower()
-                self.brain[user_key] = status.id
                 expanded_tweet = self.expand_twitter_urls(status)
                 formatted = self.ircify(status.user.screen_name,
                         expanded_tweet)#, emoji=u'🐦')
-                self.brain[tweetkey] = formatted
-                messages.extend(formatted)
+                if updates is None:
+                    self.brain.set_many({user_key: status.id,
+                        tweetkey: formatted})
+                else:
+                    updates.update({user_key: status.id, tweetkey: formatted})
+                results[tweet_id] = formatted
+            except Throttled as e:
+                results[tweet_id] = list(self.brain.get_many([tweetkey],
+                    stale=True).get(tweetkey, [self._twitter_error(e)]))
             except tweepy.TweepError as e:
-                messages.append(str(e.message[0]['message']))
-        return messages
+                results[tweet_id] = [self._twitter_error(e)]
+        return results
+
+    def _twitter_error(self, e):
+        """the message twitter sent with an error
+        
+        Args:
+            e (TweepError): the error
+        
+        Returns:
+            str: the message
+        """
+        errors = e.args[0] if e.args else None
+        if isinstance(errors, list) and errors and 'message' in errors[0]:
+            return str(errors[0]['message'])
+        return str(e)
 
     def _is_number(self, stronk):
         """idk why I use this
@@ -739,9 +1033,36 @@ class Collapse(object):
         except ValueError:
             return False
 
+    def _url_job(self, future, updates, default):
+        """wait for one of url()'s fetches. one that failed is logged and
+           skipped, and whatever it meant to save is thrown away, so the
+           rest of the message still goes out and gets saved
+        
+        Args:
+            future (Future): the fetch
+            updates (dict): the brain updates it collected
+            default (object): stands in for its result if it failed
+        
+        Returns:
+            object: what it returned, or default
+        """
+        try:
+            return future.result()
+        except Exception as e:
+            logging.exception(e)
+            updates.clear()
+            return default
+
     def url(self, urls, author=None):
         """process urls
         
+        Tweets (in one lookup) and toots are fetched at once on url_pool,
+        without holding any lock, so a message costs about as long as its
+        slowest link. Only the repost bookkeeping is serialized, and only
+        against other messages with the same URLs. Everything learned is
+        saved to the brain in one batch at the end; a fetch that fails is
+        logged and left out without losing the others.
+        
         Args:
             urls (list): list of str
             author (None, optional): the person that posted the url
@@ -749,46 +1070,87 @@ class Collapse(object):
         Returns:
             list: list of str
         """
-        self.lock()
-        messages = []
+        tweet_ids = []
         for url in urls:
-            hexed = self._hexurl(url)
-            key = 'urls_' + hexed
-            first_author_key = 'firstpost_' + hexed
+            parts = url.split('/')
+            if len(parts) > 2 and parts[2].endswith('twitter.com'):
+                for i, part in enumerate(parts):
+                    if part in ('status', 'statuses') and len(author) != 1:
+                        tweet_ids.append(parts[i + 1])
+        # each job gets its own dict of brain updates, merged at the end
+        fetched = {}
+        tweets = None
+        if tweet_ids:
+            fetched[None] = {}
+            tweets = self.url_pool.submit(self.process_tweets, tweet_ids,
+                via=author, updates=fetched[None])
+        toots = {}
+        for url in urls:
+            parts = url.split('/')
+            if len(parts) > 2 and self._is_number(parts[-1]) and \
+                    parts[-2][0] == '@' and len(author) != 1 and \
+                    url not in toots:
+                fetched[url] = {}
+                toots[url] = self.url_pool.submit(self.process_toot, url,
+                    updates=fetched[url])
+        tweets = self._url_job(tweets, fetched[None], {}) \
+            if tweets is not None else {}
+        toots = dict((url, self._url_job(future, fetched[url], []))
+            for url, future in toots.items())
+
+        remote = []
+        for url in urls:
+            url_messages = []
             parts = url.split('/')
             if len(parts) > 2 and parts[2].endswith('twitter.com'):
                 for i, part in enumerate(parts):
                     if part in ('status', 'statuses'):
                         tweet_id = parts[i + 1]
                         if len(author) == 1:
-                            messages.extend(['go to hell'])
+                            url_messages.extend(['go to hell'])
                         else:
-                            messages.extend(self.process_tweet(tweet_id, via=author))
+                            url_messages.extend(tweets.get(tweet_id, []))
 
             if len(parts) > 2 and self._is_number(parts[-1]) and parts[-2][0] == '@':
                 if len(author) == 1:
-                    messages.extend(['go to hell'])
+                    url_messages.extend(['go to hell'])
                 else:
-                    messages.extend(self.process_toot(url))
+                    url_messages.extend(toots[url])
+            remote.append(url_messages)
 
-            current_time = time()
-            if key in self.brain:
-                orig_date = self.brain[key]
-                if (current_time - orig_date) > 120.0:
-                    delta = datetime.now() - datetime.fromtimestamp(orig_date)
-                    if author != self.brain[first_author_key]:
-                        messages.append(
-                            "Thanks for posting %s's link again. (%s ago)" % \
-                                (self.brain[first_author_key],
-                                    format_timedelta(delta, locale='en_US')))
-                    else:
-                        messages.append("You posted this %s ago, %s." % \
-                            (format_timedelta(delta, locale='en_US'),
-                                random.choice(self.insults)))
-            elif len(author) > 1:
-                self.brain[key] = int(time())
-                self.brain[first_author_key] = author
-        self.unlock()
+        messages = []
+        hexes = dict((url, self._hexurl(url)) for url in urls)
+        keys = [prefix + hexed for hexed in hexes.values()
+            for prefix in ('urls_', 'firstpost_')]
+        with self.key_lock(keys):
+            known = self.brain.get_many(keys)
+            updates = {}
+            for job_updates in fetched.values():
+                updates.update(job_updates)
+            for url, url_messages in zip(urls, remote):
+                messages.extend(url_messages)
+                hexed = hexes[url]
+                key = 'urls_' + hexed
+                first_author_key = 'firstpost_' + hexed
+                current_time = time()
+                if key in known:
+                    orig_date = known[key]
+                    if (current_time - orig_date) > 120.0:
+                        delta = datetime.now() - datetime.fromtimestamp(orig_date)
+                        if author != known[first_author_key]:
+                            messages.append(
+                                "Thanks for posting %s's link again. (%s ago)" % \
+                                    (known[first_author_key],
+                                        format_timedelta(delta, locale='en_US')))
+                        else:
+                            messages.append("You posted this %s ago, %s." % \
+                                (format_timedelta(delta, locale='en_US'),
+                                    random.choice(self.insults)))
+                elif len(author) > 1:
+                    updates[key] = known[key] = int(time())
+                    updates[first_author_key] = known[first_author_key] = author
+            if updates:
+                self.brain.set_many(updates)
         return messages
 
     def said(self, nick, message):
@@ -798,6 +1160,4 @@ class Collapse(object):
             nick (str): user
             message (str): the message
         """
-        self.lock()
         self.brain['said_' + nick] = message
-        self.unlock()
@@ -1,11 +1,20 @@
 import urllib.request, urllib.parse, urllib.error
 import sys, os
 import shelve
+import threading
+import time
 from urllib.parse import urlparse
 from collapse.namespacedBrain import NamespacedBrain
-from requests_futures.sessions import FuturesSession
+import requests
+from collapse.httpClient import HTTPClient
 import hashlib
 
+# hosts that only exist to redirect somewhere else, always worth a HEAD
+SHORTENERS = ('t.co', 'bit.ly', 'goo.gl', 'tinyurl.com', 'ow.ly', 'buff.ly',
+    'is.gd', 'dlvr.it', 'ift.tt', 'trib.al', 'amzn.to', 'fb.me', 'lnkd.in',
+    't.ly', 'cutt.ly', 'rebrand.ly', 'tiny.cc', 'bl.ink', 'shorturl.at',
+    'youtu.be', 'spoti.fi', 'wp.me', 'redd.it', 'git.io')
+
 def make_result(startUrl, endUrl):
     """coalesce starting, ending urls into a result structure
     
@@ -33,38 +42,189 @@ def _hexurl(url):
         str: the hexed url
     """
     h = hashlib.sha1()
-    h.update(url)
+    h.update(url.encode('utf-8'))
     return h.hexdigest()
 
+class ExpansionCache:
+    """Where short URLs ended up, kept in the brain under 'expanded_' plus
+    the sha1 of the URL that was fetched. Each entry records the end URL,
+    the final HTTP status (None if the fetch failed) and when it was
+    fetched. Failures are only trusted for negative_ttl seconds so a flaky
+    shortener gets another try; successes live until the brain's
+    ttl_expanded sweeps them.
+    
+    Attributes:
+        age_total (float): summed age in seconds of every entry served
+        brain (NamespacedBrain): storage
+        hits (int): lookups answered from a successful fetch
+        misses (int): lookups with nothing usable cached
+        negative_hits (int): lookups answered from a recent failure
+        negative_ttl (float): seconds a failure is cached for
+        stale (int): failures found past negative_ttl, counted in misses too
+    """
+
+    def __init__(self, brain, negative_ttl=300):
+        """constructor
+        
+        Args:
+            brain (NamespacedBrain): storage
+            negative_ttl (float, optional): seconds a failure is cached for
+        """
+        self.brain = brain
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.stale = 0
+        self.age_total = 0.0
+
+    def key(self, url):
+        """brain key for a start URL
+        
+        Args:
+            url (str): the URL that was fetched
+        
+        Returns:
+            str: the key
+        """
+        return 'expanded_' + _hexurl(url)
+
+    def _fresh(self, entry, now, count=True):
+        """count a cached entry, and decide whether it's still usable
+        
+        Args:
+            entry (object): the stored value, a bare end URL for entries
+                written before statuses were kept
+            now (float): the time
+            count (bool, optional): whether it goes in the counters
+        
+        Returns:
+            dict: the entry, or None if it's a failure that's too old
+        """
+        if not isinstance(entry, dict):
+            entry = {'end_url': entry, 'status': 200, 'fetched': None}
+        age = now - entry['fetched'] if entry['fetched'] else 0
+        if entry['status'] is None and age > self.negative_ttl:
+            if count:
+                self.stale += 1
+                self.misses += 1
+            return None
+        if count:
+            if entry['status'] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            self.age_total += age
+        return entry
+
+    def get(self, url):
+        """look up a start URL
+        
+        Args:
+            url (str): the URL
+        
+        Returns:
+            dict: end_url, status and fetched, or None on a miss
+        """
+        return self.get_many([url]).get(url)
+
+    def get_many(self, urls, count=True):
+        """look up several start URLs with one brain round trip
+        
+        Args:
+            urls (list): the URLs
+            count (bool, optional): whether the lookups go in the counters,
+                off for a second look at URLs that were already counted
+        
+        Returns:
+            dict: url -> entry, only for usable entries
+        """
+        keys = dict((url, self.key(url)) for url in urls)
+        known = self.brain.get_many(keys.values())
+        now = time.time()
+        found = {}
+        for url, key in keys.items():
+            entry = self._fresh(known[key], now, count) if key in known \
+                else None
+            if entry is None:
+                if key not in known and count:
+                    self.misses += 1
+                continue
+            found[url] = entry
+        return found
+
+    def store(self, url, end_url, status):
+        """remember where a URL went
+        
+        Args:
+            url (str): the URL that was fetched
+            end_url (str): where the redirects ended
+            status (int): the final HTTP status, None for a failure
+        """
+        self.brain[self.key(url)] = {
+            'end_url': end_url,
+            'status': status,
+            'fetched': time.time()
+        }
+
+    def stats(self):
+        """counters for reporting
+        
+        Returns:
+            dict: hits, negative_hits, misses, stale, ratio and mean_age
+        """
+        served = self.hits + self.negative_hits
+        lookups = served + self.misses
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'ratio': float(served) / lookups if lookups else 0.0,
+            'mean_age': self.age_total / served if served else 0.0
+        }
+
 class WrappedFuture:
     """Wrap a request future into a structure to consume elsewhere
     
     Attributes:
-        brain (NamespacedBrain): the storage
-        future (object): request_futures
+        cache (ExpansionCache): where the result is stored
+        future (Future): the HEAD request from HTTPClient
         startUrl (str): input URL
     """
     
-    def __init__(self, startUrl, future, brain):
-        self.brain = brain
+    def __init__(self, startUrl, future, cache, result=None):
+        self.cache = cache
         self.future = future
         self.startUrl = startUrl
+        self._result = result
+        self._lock = threading.Lock()
 
     def finish(self):
-        """finish the request
+        """finish the request. It's only stored once, everyone sharing
+        this future gets the same result.
         
         Returns:
             dict: result from make_result
         """
+        with self._lock:
+            if self._result is None:
+                self._result = self._finish()
+            return self._result
+
+    def _finish(self):
         try:
             if self.future is False:
                 return
             resp = self.future.result()
             print('Finished getting ' + resp.url)
             newUrl = resp.url
-            key = 'expanded_' + _hexurl(newUrl)
-            self.brain[key] = newUrl
+            self.cache.store(self.startUrl, newUrl, resp.status_code)
             return make_result(self.startUrl, newUrl)
+        except requests.exceptions.RequestException as e:
+            print(e)
+            self.cache.store(self.startUrl, self.startUrl, None)
+            return make_result(self.startUrl, self.startUrl)
         except KeyError as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -77,15 +237,43 @@ class ExpandURL:
     
     Attributes:
         brain (NamespacedBrain): storage
-        session (FuturesSession): FuturesSession
+        cache (ExpansionCache): where expansions are remembered
+        http (HTTPClient): shared HTTP client
+        learn_after (int): fetches without a redirect before a domain is
+            treated as one that never redirects
+        saved (int): expand() calls that joined a fetch already in flight
+        shorteners (set): domains that are always expanded
+        skipped (int): expand() calls answered without a fetch because the
+            domain doesn't redirect
     """
     
-    def __init__(self):
-        self.brain = NamespacedBrain()
-        self.session = FuturesSession()
+    def __init__(self, brain=None, negative_ttl=300, http=None,
+            shorteners=SHORTENERS, learn_after=3):
+        """constructor
+        
+        Args:
+            brain (NamespacedBrain, optional): storage to share, a flat file
+                brain is opened if not given
+            negative_ttl (float, optional): seconds a failed expansion is
+                cached for
+            http (HTTPClient, optional): HTTP client to share
+            shorteners (list, optional): domains that are always expanded
+            learn_after (int, optional): fetches without a redirect before a
+                domain stops being expanded
+        """
+        self.brain = brain if brain is not None else NamespacedBrain()
+        self.cache = ExpansionCache(self.brain, negative_ttl)
+        self.http = http if http is not None else HTTPClient()
+        self.shorteners = set(shorteners)
+        self.learn_after = learn_after
+        self.skipped = 0
+        self.saved = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
 
     def expand(self, url):
-        """expand a URL
+        """expand a URL. Callers asking for a URL that's already being
+        fetched share that fetch instead of starting another.
         
         Args:
             url (str): input URL
@@ -93,16 +281,97 @@ class ExpandURL:
         Returns:
             WrappedFuture: WrappedFuture
         """
-        print('expanding ' + url)
         try:
-            if len(url) > 50:
-                self.brain['expanded_' + _hexurl(url)] = url
-            future = self.session.head(url, allow_redirects=True)
-            return WrappedFuture(url, future, self.brain)
-        except (requests.exceptions.RequestException, requests.exceptions.TooManyRedirects) as e:
+            if not self.worth_expanding(url):
+                self.skipped += 1
+                return WrappedFuture(url, None, self.cache,
+                    result=make_result(url, url))
+            with self._lock:
+                if url in self._inflight:
+                    self.saved += 1
+                    return self._inflight[url]
+                print('expanding ' + url)
+                wrapped = WrappedFuture(url,
+                    self.http.submit('HEAD', url, allow_redirects=True),
+                    self.cache)
+                self._inflight[url] = wrapped
+            wrapped.future.add_done_callback(
+                lambda future: self._landed(wrapped))
+            return wrapped
+        except (requests.exceptions.RequestException, requests.exceptions.TooManyRedirects, ValueError) as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
             print((exc_type, fname, exc_tb.tb_lineno))
             print(e)
             return False
+
+    def _landed(self, wrapped):
+        """store a finished fetch and stop handing it out, runs on the
+        session's worker thread
         
+        Args:
+            wrapped (WrappedFuture): the fetch
+        """
+        try:
+            result = wrapped.finish()
+        finally:
+            with self._lock:
+                if self._inflight.get(wrapped.startUrl) is wrapped:
+                    del self._inflight[wrapped.startUrl]
+        if wrapped.future.exception() is None:
+            self._learn(result)
+
+    def _domain(self, url):
+        """the domain a URL is on, for deciding whether to expand it
+        
+        Args:
+            url (str): the URL
+        
+        Returns:
+            str: lowercased host without the port or a leading www.
+        """
+        domain = (urlparse(url).hostname or '').lower()
+        if domain.startswith('www.'):
+            domain = domain[4:]
+        return domain
+
+    def _domainKey(self, domain):
+        return 'domain_' + _hexurl(domain)
+
+    def worth_expanding(self, url):
+        """could fetching this URL lead somewhere else? Known shorteners
+        always could; any other domain could until it's been fetched
+        learn_after times without ever redirecting to another domain.
+        
+        Args:
+            url (str): the URL
+        
+        Returns:
+            bool: yep
+        """
+        domain = self._domain(url)
+        if domain in self.shorteners:
+            return True
+        key = self._domainKey(domain)
+        seen = self.brain.get_many([key]).get(key)
+        return seen is None or seen['redirected'] or \
+            seen['fetches'] < self.learn_after
+
+    def _learn(self, result):
+        """record whether a fetch left the domain it started on
+        
+        Args:
+            result (dict): result from make_result
+        """
+        domain = self._domain(result['start_url'])
+        if domain in self.shorteners:
+            return
+        key = self._domainKey(domain)
+        seen = self.brain.get_many([key]).get(key,
+            {'fetches': 0, 'redirected': False})
+        if seen['redirected'] or seen['fetches'] >= self.learn_after:
+            return
+        self.brain[key] = {
+            'fetches': seen['fetches'] + 1,
+            'redirected': self._domain(result['end_url']) != domain
+        }
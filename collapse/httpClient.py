@@ -0,0 +1,219 @@
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from collapse.circuitBreaker import CircuitBreaker, CircuitOpenError, CLOSED
+
+
+class HTTPClient(object):
+    """One place for every outbound HTTP request. Requests share a
+    requests.Session with keep-alive connection pools, run on a fixed set of
+    threads, and no single host gets more than per_host of those threads at
+    once; anything past that waits in a per-host queue, so a slow host
+    can't tie up the workers everyone else needs. Each host also gets a
+    CircuitBreaker, so a host that keeps failing is refused straight away
+    with a CircuitOpenError instead of costing every caller a timeout.
+    Breakers for healthy hosts are forgotten once nothing is in flight to
+    them, and idle ones are pruned when there are more than max_breakers.
+
+    Attributes:
+        breakers (dict): host -> CircuitBreaker
+        failure_threshold (int): failures in a row that open a circuit
+        max_breakers (int): breakers kept before idle ones are pruned
+        max_workers (int): requests in flight at once, across all hosts
+        open_seconds (float): how long an open circuit refuses requests
+        per_host (int): requests in flight at once to any one host
+        session (Session): the shared session
+        timeout (tuple): default (connect, read) timeout in seconds
+    """
+
+    def __init__(self, max_workers=8, per_host=2, pool_size=8,
+            connect_timeout=3.05, read_timeout=5.0, failure_threshold=5,
+            open_seconds=30, max_breakers=1024):
+        """constructor
+
+        Args:
+            max_workers (int, optional): requests in flight across all hosts
+            per_host (int, optional): requests in flight to one host
+            pool_size (int, optional): kept-alive connections per host
+            connect_timeout (float, optional): default connect timeout
+            read_timeout (float, optional): default read timeout
+            failure_threshold (int, optional): failures in a row that open
+                a host's circuit
+            open_seconds (float, optional): how long an open circuit
+                refuses requests before letting a probe through
+            max_breakers (int, optional): breakers kept before idle ones
+                are pruned
+        """
+        self.max_workers = max_workers
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.breakers = {}
+        self.max_breakers = max_breakers
+        self.per_host = per_host
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers * 2,
+            pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._active = collections.Counter()
+        self._waiting = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        return urlparse(url).netloc.lower()
+
+    def breaker(self, host):
+        """Get a host's circuit breaker, creating it if necessary
+
+        Args:
+            host (str): the host
+
+        Returns:
+            CircuitBreaker: its breaker
+        """
+        with self._lock:
+            if host not in self.breakers:
+                if len(self.breakers) >= self.max_breakers:
+                    self._prune()
+                self.breakers[host] = CircuitBreaker(self.failure_threshold,
+                    self.open_seconds)
+            return self.breakers[host]
+
+    def _prune(self):
+        """Forget the breakers of hosts with nothing in flight, unless their
+        circuit is still open, callers must hold the lock"""
+        for host, breaker in list(self.breakers.items()):
+            if host not in self._active and not breaker.remaining():
+                del self.breakers[host]
+
+    def _forget(self, host):
+        """Drop a host's breaker if it has nothing to remember, callers must
+        hold the lock
+
+        Args:
+            host (str): the host
+        """
+        breaker = self.breakers.get(host)
+        if breaker is not None and breaker.state == CLOSED and \
+                not breaker.failures:
+            del self.breakers[host]
+
+    def _run(self, future, host, breaker, method, url, kwargs):
+        """Run one request on an executor thread, then start the next one
+        waiting for the same host
+
+        Args:
+            future (Future): where the response goes
+            host (str): the host it counts against
+            breaker (CircuitBreaker): the breaker that let it through
+            method (str): HTTP method
+            url (str): the URL
+            kwargs (dict): passed to Session.request
+        """
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    resp = self.session.request(method, url, **kwargs)
+                except BaseException as e:
+                    if isinstance(e, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout)):
+                        breaker.failure()
+                    else:
+                        breaker.release()
+                    future.set_exception(e)
+                else:
+                    if resp.status_code >= 500:
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                    future.set_result(resp)
+            else:
+                breaker.release()
+        finally:
+            with self._lock:
+                if self._waiting[host]:
+                    self._executor.submit(self._run,
+                        *self._waiting[host].popleft())
+                else:
+                    del self._waiting[host]
+                    self._active[host] -= 1
+                    if not self._active[host]:
+                        del self._active[host]
+                        self._forget(host)
+
+    def submit(self, method, url, **kwargs):
+        """Start a request in the background
+
+        Args:
+            method (str): HTTP method
+            url (str): the URL
+            **kwargs: passed to Session.request, timeout defaults to the
+                client's
+
+        Returns:
+            Future: resolves to the Response, or fails with a
+                CircuitOpenError if the host's circuit is open
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        future = Future()
+        host = self._host(url)
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            future.set_exception(CircuitOpenError(
+                'circuit open for %s' % host))
+            return future
+        job = (future, host, breaker, method, url, kwargs)
+        with self._lock:
+            if self._active[host] < self.per_host:
+                self._active[host] += 1
+                self._executor.submit(self._run, *job)
+            else:
+                self._waiting[host].append(job)
+        return future
+
+    def request(self, method, url, **kwargs):
+        """Make a request and wait for it
+
+        Args:
+            method (str): HTTP method
+            url (str): the URL
+            **kwargs: passed to Session.request
+
+        Returns:
+            Response: the response
+
+        Raises:
+            RequestException: whatever requests raised
+        """
+        return self.submit(method, url, **kwargs).result()
+
+    def get(self, url, **kwargs):
+        """GET and wait, see request()"""
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """HEAD and wait, see request()"""
+        return self.request('HEAD', url, **kwargs)
+
+    def breaker_status(self):
+        """Describe every circuit that isn't closed, for reporting
+
+        Returns:
+            list: one str per host
+        """
+        with self._lock:
+            breakers = sorted(self.breakers.items())
+        return ['%s %s (%d failures, %d refused%s)' % (host, breaker.state,
+                breaker.failures, breaker.rejected,
+                ', %.1fs left' % breaker.remaining() if breaker.remaining() else '')
+            for host, breaker in breakers if breaker.state != CLOSED]
+
+    def close(self):
+        """Stop taking requests and drop the kept-alive connections"""
+        self._executor.shutdown(wait=False)
+        self.session.close()
@@ -1,88 +1,202 @@
+import hashlib
 import tempfile
 import requests
-import shutil
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from collapse.httpClient import HTTPClient
+
+# the most twitter takes for each kind of image, going by tweepy's checks
+SIZE_LIMITS = {
+    '.gif': 14649 * 1024,
+    '.png': 4883 * 1024,
+    '.jpg': 4883 * 1024,
+    '.webp': 4883 * 1024
+}
+# links ending in these aren't worth a request
+SKIP_EXTENSIONS = ('.html', '.htm', '.php', '.asp', '.aspx', '.pdf', '.mp4',
+    '.webm', '.mov', '.mp3', '.zip', '.txt', '.json', '.xml')
+# bytes needed to tell the image types apart
+SNIFF_BYTES = 12
 
 class ImageGetter(object):
     """Grabs images to upload to twitter from URLs
     
     Attributes:
-        timeout (int): how long to wait for images before giving up
+        cache (MediaCache): downloaded images, None to not keep them
+        http (HTTPClient): shared HTTP client
+        spool_bytes (int): images bigger than this are buffered on disk
+        timeout (float): how long to wait for images before giving up
+        workers (int): images fetched (and uploaded) at once
     """
     
-    _suffix_types = {
-        'image/gif': '.gif',
-        'image/png': '.png',
-        'image/jpg': '.jpg',
-        'image/jpeg': '.jpg'
-    }
-
-    def __init__(self, timeout=1.0):
+    def __init__(self, timeout=1.5, http=None, workers=4, cache=None,
+            spool_bytes=1024 * 1024):
         """constructor
         
         Args:
             timeout (float, optional): length of timeout
+            http (HTTPClient, optional): HTTP client to share
+            workers (int, optional): images fetched at once
+            cache (MediaCache, optional): where to keep downloaded images
+            spool_bytes (int, optional): images bigger than this are
+                buffered on disk instead of in memory
         """
         self.timeout = timeout
+        self.cache = cache
+        self.http = http if http is not None else HTTPClient()
+        self.workers = workers
+        self.spool_bytes = spool_bytes
+        self._pool = ThreadPoolExecutor(max_workers=workers)
 
-    def _get_suffix(self, content_type):
-        """detect the file type from the Content-Type header
+    def _sniff(self, head):
+        """detect the file type from the first few bytes of the body
         
         Args:
-            content_type (str): Content-Type header
+            head (bytes): start of the body
         
         Returns:
-            str: the "suffix"
+            str: the "suffix", or None if it isn't an image twitter takes
         """
-        content_type = content_type.split(';')[0]
-        if content_type in self._suffix_types:
-            return self._suffix_types[content_type]
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            return '.png'
+        if head.startswith(b'\xff\xd8\xff'):
+            return '.jpg'
+        if head.startswith(b'GIF87a') or head.startswith(b'GIF89a'):
+            return '.gif'
+        if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+            return '.webp'
         return None
 
-    def get_images(self, text):
-        """Parse a text body for images
+    def _fetch(self, url, upload):
+        """download one image, unless it's cached, and hand it to upload
+        
+        Args:
+            url (str): link to image
+            upload (callable): called with the image's filename, the sha256
+                of its contents, and an open file to read it from
+        
+        Returns:
+            tuple: (True, what upload returned), or (False, None) if it's
+                not an image
+        """
+        if self.cache is not None:
+            cached = self.cache.get(url)
+            if cached is not None:
+                with cached[2]:
+                    return (True, upload(*cached))
+        image = self.get_image(url)
+        if image is None:
+            return (False, None)
+        body, suffix, digest = image
+        with body:
+            if self.cache is not None:
+                cached = self.cache.add(url, body, suffix, digest)
+                with cached[2]:
+                    return (True, upload(*cached))
+            return (True, upload('image' + suffix, digest, body))
+
+    def get_images(self, text, upload):
+        """Parse a text body for images. Every link is fetched at once, and
+        each image is uploaded as soon as its download finishes.
         
         Args:
             text (str): text body
+            upload (callable): called with each image's filename, the sha256
+                of its contents, and an open file to read it from; on one of
+                the fetching threads
         
         Returns:
-            list: list of image filenames
+            tuple: the text without the image links, and what upload returned
+                for each image, in the order the links appeared
         """
+        parts = text.split()
+        fetches = {}
+        for i, part in enumerate(parts):
+            if part.startswith('http:') or part.startswith('https:'):
+                fetches[i] = self._pool.submit(self._fetch, part, upload)
         out = []
         media = []
-        for part in text.split():
-            if part.startswith('http:') or part.startswith('https:'):
-                res = self.get_image(part)
-                if res is not None:
-                    media.append(res)
-                else:
-                    out.append(part)
-            else:
+        try:
+            for i, part in enumerate(parts):
+                if i in fetches:
+                    is_image, res = fetches[i].result()
+                    if is_image:
+                        media.append(res)
+                        continue
                 out.append(part)
+        finally:
+            # if an upload blew up, let the rest finish and clean up after
+            # themselves before the error goes anywhere
+            for fetch in fetches.values():
+                fetch.exception()
         return (' '.join(out), media)
 
     def get_image(self, url):
-        """get an image body
+        """get an image body. Links that obviously aren't images are skipped
+        without a request, a body that says it's something else is never
+        read, and anything else is dropped as soon as its first bytes turn
+        out not to be an image or it grows past twitter's limit.
         
         Args:
             url (str): link to image
         
         Returns:
-            str: filename of image body
+            tuple: (SpooledTemporaryFile rewound to the start, suffix, sha256
+                hex digest), or None if it's not an image
         """
+        if urlparse(url).path.lower().endswith(SKIP_EXTENSIONS):
+            return None
         try:
-            req = requests.get(url, stream=True, timeout=1.5)
-            if req.status_code == 200 and \
-                req.headers['content-type'].startswith('image'):
-                suffix = self._get_suffix(req.headers['content-type'])
-                if suffix is not None:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
-                        req.raw.decode_content = True
-                        shutil.copyfileobj(req.raw, f)
-                        f.close()
-                        return f.name
-            else:
-                return None
+            req = self.http.get(url, stream=True, timeout=self.timeout)
         except requests.exceptions.Timeout as e:
             return None
         except requests.exceptions.ConnectionError as e:
             return None
+        body = None
+        try:
+            content_type = req.headers.get('content-type', '').split(';')[0]
+            if req.status_code != 200 or (content_type and
+                    not content_type.startswith('image/') and
+                    content_type != 'application/octet-stream'):
+                return None
+            length = req.headers.get('content-length', '')
+            length = int(length) if length.isdigit() else 0
+            if length > max(SIZE_LIMITS.values()):
+                return None
+            chunks = req.iter_content(chunk_size=16384)
+            head = b''
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= SNIFF_BYTES:
+                    break
+            suffix = self._sniff(head)
+            if suffix is None or length > SIZE_LIMITS[suffix]:
+                return None
+            digest = hashlib.sha256(head)
+            body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+            body.write(head)
+            size = len(head)
+            for chunk in chunks:
+                size += len(chunk)
+                if size > SIZE_LIMITS[suffix]:
+                    body.close()
+                    return None
+                digest.update(chunk)
+                body.write(chunk)
+            body.seek(0)
+            image, body = body, None
+            return (image, suffix, digest.hexdigest())
+        except (requests.exceptions.RequestException,
+                urllib3.exceptions.HTTPError, IOError) as e:
+            return None
+        finally:
+            if body is not None:
+                body.close()
+            # hand the connection back to the pool, or drop it if the body
+            # wasn't read
+            req.close()
+
+    def close(self):
+        """wait for uploads in flight to finish and stop the workers"""
+        self._pool.shutdown(wait=True)
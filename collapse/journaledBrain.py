@@ -0,0 +1,281 @@
+import json
+import os
+import collections
+import threading
+import queue
+from collapse.namespacedBrain import NamespacedBrain
+
+JOURNAL_SUFFIX = '.journal'
+ROTATED_SUFFIX = '.journal.old'
+TEMP_SUFFIX = '.tmp'
+
+
+class JournaledBrain(NamespacedBrain):
+    """JournaledBrain keeps the NamespacedBrain bucket layout, but a write
+    appends one small record to a journal next to the bucket file instead of
+    rewriting the whole bucket. A bucket is replayed into an in-memory index
+    the first time it's touched, and a background thread folds the journal
+    back into the bucket file once it grows past compact_bytes.
+
+    Journal records are one JSON list per line, [key, value] for a write and
+    [key] for a removal. A record torn by a crash is cut off the end of the
+    journal when it's replayed, and appends always start on a fresh line.
+
+    Attributes:
+        compact_bytes (int): journal size that triggers a compaction
+        compactions (int): number of compactions finished
+        index (OrderedDict): bucket path -> replayed bucket contents
+        index_buckets (int): how many replayed buckets to keep in memory
+        journalSizes (dict): bucket path -> journal size in bytes
+    """
+
+    def __init__(self, *args, **kwargs):
+        """constructor
+
+        Args:
+            *args: passed to NamespacedBrain
+            **kwargs: passed to NamespacedBrain, 'compact_bytes' and
+                'index_buckets' are checked here
+        """
+        self.compact_bytes = int(kwargs.pop('compact_bytes', 65536))
+        self.index_buckets = int(kwargs.pop('index_buckets', 4096))
+        super(JournaledBrain, self).__init__(*args, **kwargs)
+        self.index = collections.OrderedDict()
+        self.journalSizes = {}
+        self.compactions = 0
+        self._lock = threading.RLock()
+        self._compactQueue = queue.Queue()
+        self._compactPending = set()
+        self._compactThread = None
+
+    def _replay(self, path, contents):
+        """Apply the records in a journal file to a bucket
+
+        Args:
+            path (str): the journal file
+            contents (dict): bucket contents to update in place
+        """
+        if not os.path.exists(path):
+            return
+        good = 0
+        with open(path, 'rb+') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if not line.endswith(b'\n'):
+                        # a torn write at the tail, cut it off so the next
+                        # append doesn't land on the same line
+                        f.truncate(good)
+                        break
+                    # mangled by an old torn write, the records after it
+                    # are still good
+                    good += len(line)
+                    continue
+                good += len(line)
+                if len(record) > 1:
+                    contents[record[0]] = record[1]
+                else:
+                    contents.pop(record[0], None)
+
+    def _bucket(self, fn):
+        """Get the replayed contents of a bucket, loading it if necessary.
+        Callers must hold the lock.
+
+        Args:
+            fn (str): path to the bucket file
+
+        Returns:
+            dict: the bucket contents
+        """
+        if fn in self.index:
+            self.index.move_to_end(fn)
+            return self.index[fn]
+        contents = self._loadBucket(fn)
+        self._replay(fn + ROTATED_SUFFIX, contents)
+        self._replay(fn + JOURNAL_SUFFIX, contents)
+        journal = fn + JOURNAL_SUFFIX
+        self.journalSizes[fn] = os.path.getsize(journal) \
+            if os.path.exists(journal) else 0
+        self.index[fn] = contents
+        while len(self.index) > self.index_buckets:
+            # everything is already on disk, so dropping a bucket from the
+            # index only costs a replay the next time it's read
+            evicted, _ = self.index.popitem(last=False)
+            self.journalSizes.pop(evicted, None)
+        return contents
+
+    def _bucketName(self, filename):
+        """Map a file in a namespace directory to the bucket it belongs to
+
+        Args:
+            filename (str): name of a file in a namespace directory
+
+        Returns:
+            str: the bucket name, or None if the file isn't a bucket
+        """
+        for suffix in (ROTATED_SUFFIX, JOURNAL_SUFFIX):
+            if filename.endswith(suffix):
+                return filename[:-len(suffix)]
+        return super(JournaledBrain, self)._bucketName(filename)
+
+    def _bucketExists(self, fn):
+        """Is there anything stored for a bucket?
+
+        Args:
+            fn (str): path to the bucket file
+
+        Returns:
+            bool: yep
+        """
+        return os.path.exists(fn) or os.path.exists(fn + JOURNAL_SUFFIX) or \
+            os.path.exists(fn + ROTATED_SUFFIX)
+
+    def _peekBucket(self, fn):
+        """Get a bucket's contents for a scan without adding it to the index
+
+        Args:
+            fn (str): path to the bucket file
+
+        Returns:
+            dict: the bucket contents
+        """
+        with self._lock:
+            if fn in self.index:
+                return dict(self.index[fn])
+            contents = self._loadBucket(fn)
+            self._replay(fn + ROTATED_SUFFIX, contents)
+            self._replay(fn + JOURNAL_SUFFIX, contents)
+            return contents
+
+    def _readBucket(self, fn):
+        """Get a bucket's contents from the index
+
+        Args:
+            fn (str): path to the bucket file
+
+        Returns:
+            dict: the bucket contents
+        """
+        with self._lock:
+            return self._bucket(fn)
+
+    def _updateBucket(self, fn, updates, removals=()):
+        """Apply writes and removals to the index, and append them to the
+        bucket's journal in one go
+
+        Args:
+            fn (str): path to the bucket file
+            updates (dict): keys and values to write
+            removals (list, optional): keys to remove
+        """
+        with self._lock:
+            contents = self._bucket(fn)
+            records = []
+            for key, val in updates.items():
+                contents[key] = val
+                records.append([key, val])
+            for key in removals:
+                if key in contents:
+                    del contents[key]
+                    records.append([key])
+            if records:
+                self._append(fn, records)
+
+    def _append(self, fn, records):
+        """Append records to a bucket's journal. Callers must hold the lock.
+
+        Args:
+            fn (str): path to the bucket file
+            records (list): the journal records
+        """
+        with self._openJournal(fn + JOURNAL_SUFFIX) as out:
+            out.write(''.join(json.dumps(record) + '\n'
+                for record in records).encode('utf-8'))
+            self.journalSizes[fn] = out.tell()
+        if self.journalSizes[fn] > self.compact_bytes:
+            self._scheduleCompaction(fn)
+
+    def _openJournal(self, path):
+        """Open a journal for appending, starting a new line first if the
+        last record in it was torn
+
+        Args:
+            path (str): the journal file
+
+        Returns:
+            file: opened for binary appends
+        """
+        out = open(path, 'ab+')
+        if out.seek(0, os.SEEK_END):
+            out.seek(-1, os.SEEK_END)
+            if out.read(1) != b'\n':
+                out.write(b'\n')
+        return out
+
+    def _scheduleCompaction(self, fn):
+        """Queue a bucket for compaction on the background thread
+
+        Args:
+            fn (str): path to the bucket file
+        """
+        if fn in self._compactPending:
+            return
+        self._compactPending.add(fn)
+        self._compactQueue.put(fn)
+        if self._compactThread is None:
+            self._compactThread = threading.Thread(target=self._compactLoop,
+                daemon=True)
+            self._compactThread.start()
+
+    def _compactLoop(self):
+        """Background compaction thread"""
+        while True:
+            fn = self._compactQueue.get()
+            if fn is None:
+                return
+            try:
+                self.compact(fn)
+            except (IOError, OSError, ValueError) as e:
+                print(e)
+            finally:
+                with self._lock:
+                    self._compactPending.discard(fn)
+
+    def compact(self, fn):
+        """Fold a bucket's journal into its bucket file. The journal is rotated
+        under the lock so writes can keep appending while the new bucket file
+        is written out.
+
+        Args:
+            fn (str): path to the bucket file
+        """
+        journal = fn + JOURNAL_SUFFIX
+        rotated = fn + ROTATED_SUFFIX
+        with self._lock:
+            contents = dict(self._bucket(fn))
+            if os.path.exists(journal):
+                if os.path.exists(rotated):
+                    # an earlier compaction didn't finish, keep its records
+                    with open(journal, 'rb') as src, \
+                            self._openJournal(rotated) as dst:
+                        dst.write(src.read())
+                    os.unlink(journal)
+                else:
+                    os.rename(journal, rotated)
+            self.journalSizes[fn] = 0
+        tmp = fn + TEMP_SUFFIX
+        self._dumpBucket(tmp, contents)
+        with self._lock:
+            os.replace(tmp, fn)
+            if os.path.exists(rotated):
+                os.unlink(rotated)
+            self.compactions += 1
+
+    def close(self):
+        """Finish any queued compactions and stop the compaction thread"""
+        if self._compactThread is not None:
+            self._compactQueue.put(None)
+            self._compactThread.join()
+            self._compactThread = None
+        super(JournaledBrain, self).close()
@@ -0,0 +1,158 @@
+import json
+import collections
+import threading
+import time
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """Least recently used cache for brain values. Capacity can be given in
+    entries, in (approximate, JSON encoded) bytes, or both, and namespaces
+    (the part of a key before the first underscore) can get their own entry
+    limits so one chatty namespace can't push everything else out. Entries
+    can be given an expiry time, after which they read as misses.
+
+    Attributes:
+        evictions (int): entries dropped to make room
+        hits (int): lookups served from the cache
+        max_bytes (int): byte capacity, None for no limit
+        max_entries (int): entry capacity, None for no limit
+        misses (int): lookups that weren't cached
+        namespace_limits (dict): namespace -> entry capacity
+        size (int): approximate size of everything cached, in bytes
+    """
+
+    def __init__(self, max_entries=50, max_bytes=None, namespace_limits=None):
+        """constructor
+
+        Args:
+            max_entries (int, optional): entry capacity
+            max_bytes (int, optional): byte capacity
+            namespace_limits (dict, optional): namespace -> entry capacity
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.namespace_limits = namespace_limits or {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def _namespace(self, key):
+        return key.split('_')[0]
+
+    def _sizeOf(self, key, val):
+        try:
+            return len(key) + len(json.dumps(val))
+        except (TypeError, ValueError):
+            return len(key)
+
+    def _drop(self, key):
+        """Remove a key, callers must hold the lock
+
+        Args:
+            key (str): key!
+        """
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+        ns = self._namespace(key)
+        if ns in self._namespaces:
+            self._namespaces[ns].pop(key, None)
+            if not self._namespaces[ns]:
+                del self._namespaces[ns]
+
+    def _evict(self, ns):
+        """Evict least recently used entries until every limit holds,
+        callers must hold the lock
+
+        Args:
+            ns (str): the namespace that was just written to
+        """
+        limit = self.namespace_limits.get(ns)
+        while limit is not None and ns in self._namespaces and \
+                len(self._namespaces[ns]) > limit:
+            self._drop(next(iter(self._namespaces[ns])))
+            self.evictions += 1
+        while self._entries and (
+                (self.max_entries is not None and
+                    len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, key, default=MISSING):
+        """Look up a key, marking it as recently used
+
+        Args:
+            key (str): key!
+            default (object, optional): returned on a miss
+
+        Returns:
+            object: the cached value, or default
+        """
+        with self._lock:
+            if key in self._entries:
+                expires = self._entries[key][2]
+                if expires is not None and expires <= time.time():
+                    self._drop(key)
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            ns = self._namespace(key)
+            self._namespaces[ns].move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, val, expires=None):
+        """Cache a value
+
+        Args:
+            key (str): key!
+            val (object): value!
+            expires (float, optional): when it stops being valid, None for
+                never
+        """
+        size = self._sizeOf(key, val)
+        ns = self._namespace(key)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (val, size, expires)
+            self._namespaces.setdefault(ns, collections.OrderedDict())[key] = True
+            self.size += size
+            self._evict(ns)
+
+    def pop(self, key):
+        """Forget a key if it's cached
+
+        Args:
+            key (str): key!
+        """
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Counters for reporting
+
+        Returns:
+            dict: hits, misses, evictions, entries and bytes
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.size
+        }
@@ -0,0 +1,182 @@
+import collections
+import hashlib
+import os
+import shutil
+import threading
+
+TEMP_SUFFIX = '.tmp'
+
+
+class MediaCache(object):
+    """Downloaded images, kept on disk under the sha256 of their contents so
+    the same picture posted from two URLs is only stored once. Which URL
+    had which contents is kept in the brain under 'mediaurl_' plus the sha1
+    of the URL (give it a ttl_mediaurl so a URL whose image changes gets
+    fetched again). Files are evicted least recently used first once the
+    directory grows past max_bytes. Callers get files already opened under
+    the lock, so an eviction in the meantime can't pull one out from under
+    an upload.
+
+    Attributes:
+        brain (NamespacedBrain): where URLs are mapped to digests
+        directory (str): where the files live
+        evictions (int): files removed to make room
+        hits (int): URLs served without a download
+        max_bytes (int): size cap for the directory
+        misses (int): URLs that had to be downloaded
+        size (int): bytes in the directory
+    """
+
+    def __init__(self, directory, brain, max_bytes=256 * 1024 * 1024):
+        """constructor
+
+        Args:
+            directory (str): where the files live, created if necessary
+            brain (NamespacedBrain): where URLs are mapped to digests
+            max_bytes (int, optional): size cap for the directory
+        """
+        self.directory = directory
+        self.brain = brain
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        found = []
+        for name in os.listdir(directory):
+            if name.endswith(TEMP_SUFFIX):
+                # left over from a crash in the middle of add()
+                os.unlink(os.path.join(directory, name))
+                continue
+            st = os.stat(os.path.join(directory, name))
+            found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self.size += size
+
+    def _urlKey(self, url):
+        return 'mediaurl_' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _touch(self, name):
+        """mark a file as recently used, callers must hold the lock
+
+        Args:
+            name (str): file name in the directory
+        """
+        self._files.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def _open(self, name):
+        """open a cached file and mark it as recently used, callers must
+        hold the lock. a file that's gone from disk is forgotten.
+        
+        Args:
+            name (str): file name in the directory
+        
+        Returns:
+            file: opened for reading, or None if it isn't cached
+        """
+        if name not in self._files:
+            return None
+        try:
+            body = open(os.path.join(self.directory, name), 'rb')
+        except FileNotFoundError:
+            self.size -= self._files.pop(name)
+            return None
+        self._touch(name)
+        return body
+
+    def _evict(self, keep):
+        """remove the least recently used files until the directory fits,
+        callers must hold the lock
+
+        Args:
+            keep (str): file name that must stay, the one just added
+        """
+        for name in list(self._files):
+            if self.size <= self.max_bytes:
+                return
+            if name == keep:
+                continue
+            self.size -= self._files.pop(name)
+            self.evictions += 1
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def get(self, url):
+        """find the image a URL was last seen to have
+
+        Args:
+            url (str): link to image
+
+        Returns:
+            tuple: (path, digest, open file), or None if it has to be
+                downloaded. the caller closes the file
+        """
+        key = self._urlKey(url)
+        entry = self.brain.get_many([key]).get(key)
+        with self._lock:
+            if entry is not None:
+                name = entry['digest'] + entry['suffix']
+                body = self._open(name)
+                if body is not None:
+                    self.hits += 1
+                    return (os.path.join(self.directory, name),
+                        entry['digest'], body)
+            self.misses += 1
+        return None
+
+    def add(self, url, body, suffix, digest):
+        """write a downloaded image into the cache
+
+        Args:
+            url (str): where it came from
+            body (file): the download, read from where it is to the end
+            suffix (str): file extension for its type
+            digest (str): sha256 of its contents
+
+        Returns:
+            tuple: (path, digest, open file) of the cached copy. the caller
+                closes the file
+        """
+        name = digest + suffix
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            cached = self._open(name)
+        if cached is None:
+            tmp = '%s.%d%s' % (path, threading.get_ident(), TEMP_SUFFIX)
+            with open(tmp, 'wb') as out:
+                shutil.copyfileobj(body, out)
+            os.replace(tmp, path)
+            with self._lock:
+                if name in self._files:
+                    self.size -= self._files[name]
+                self._files[name] = os.path.getsize(path)
+                self.size += self._files[name]
+                self._evict(name)
+                cached = open(path, 'rb')
+        self.brain[self._urlKey(url)] = {'digest': digest, 'suffix': suffix}
+        return (path, digest, cached)
+
+    def stats(self):
+        """counters for reporting
+
+        Returns:
+            dict: hits, misses, evictions, files and bytes
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'files': len(self._files),
+            'bytes': self.size
+        }
@@ -1,6 +1,14 @@
 import json
 import os
 import collections
+import threading
+import time
+from collapse.lruCache import LRUCache, MISSING
+from collapse.bloomFilter import BloomIndex
+
+# write times for keys in namespaces with a TTL are kept in the same bucket,
+# under the key with this prefix
+STAMP_PREFIX = '\x00'
 
 
 class NamespacedBrain(dict):
@@ -9,10 +17,36 @@ class NamespacedBrain(dict):
     writing the entire file to disk every time there's a write, it's namespaced
     using underscores, which keeps things fairly nimble.
     
+    Decoded buckets are kept in memory and revalidated against the bucket
+    file's mtime and size, so repeated lookups only parse a bucket once until
+    it changes on disk.
+    
+    With write_behind on, writes only update the in-memory view and return.
+    A background thread writes each dirty bucket once per flush_interval,
+    replacing the bucket file atomically, and flush() or close() write
+    everything out on demand.
+    
+    Namespaces can be given a TTL, in which case their entries read as missing
+    once they're older than that, and sweep() removes them from disk a few
+    buckets at a time.
+    
+    Namespaces listed in bloom_namespaces get a Bloom filter, so lookups for
+    keys that were never stored are answered without reading a bucket.
+    
     Attributes:
+        bloom (BloomIndex): Bloom filters, None if there are none
+        bloom_stale (list): namespaces whose filter needs a rebuild
         braindir (str): storage location
-        cache (OrderedDict): in-memory cache
+        bucket_cache (int): how many decoded buckets to keep in memory
+        buckets (OrderedDict): bucket path -> (file signature, contents)
+        cache (LRUCache): in-memory cache
+        flush_interval (float): seconds between write-behind flushes
+        flushes (int): buckets written by the write-behind flusher
+        swept_bytes (int): approximate bytes of expired entries removed
+        swept_entries (int): expired entries removed
+        ttls (dict): namespace -> TTL in seconds
         useCache (bool): use an in-memory cache?
+        write_behind (bool): defer bucket writes to the flusher thread?
     """
     
     def __init__(self, *args, **kwargs):
@@ -20,7 +54,10 @@ class NamespacedBrain(dict):
         
         Args:
             *args: Not used, but passed to dict
-            **kwargs: Passed to dict, but also 'braindir', 'useCache' checked
+            **kwargs: Passed to dict, but also 'braindir', 'cache',
+                'cache_entries', 'cache_bytes', 'cache_limits',
+                'bucket_cache', 'ttls', 'write_behind', 'flush_interval',
+                'bloom_namespaces', 'bloom_capacity' and 'bloom_error' checked
         """
         super(NamespacedBrain, self).__init__(*args, **kwargs)
         if 'braindir' not in kwargs:
@@ -31,7 +68,34 @@ class NamespacedBrain(dict):
             os.mkdir(self.braindir)
         self.useCache = 'cache' in kwargs and kwargs['cache']
         if self.useCache:
-            self.cache = collections.OrderedDict()
+            self.cache = LRUCache(
+                max_entries=kwargs.get('cache_entries', 50),
+                max_bytes=kwargs.get('cache_bytes'),
+                namespace_limits=kwargs.get('cache_limits'))
+        self.bucket_cache = int(kwargs.get('bucket_cache', 256))
+        self.buckets = collections.OrderedDict()
+        self._dirs = set()
+        self._lock = threading.RLock()
+        self.ttls = dict(kwargs.get('ttls') or {})
+        self.swept_entries = 0
+        self.swept_bytes = 0
+        self._sweepCursor = None
+        self.write_behind = bool(kwargs.get('write_behind', False))
+        self.flush_interval = float(kwargs.get('flush_interval', 1.0))
+        self.flushes = 0
+        self._dirty = {}
+        self._flushing = {}
+        self._flushLock = threading.Lock()
+        self._flushWake = threading.Event()
+        self._flushThread = None
+        self._closing = False
+        self.bloom = None
+        self.bloom_stale = []
+        if kwargs.get('bloom_namespaces'):
+            self.bloom = BloomIndex(self.braindir, kwargs['bloom_namespaces'],
+                capacity=int(kwargs.get('bloom_capacity', 500000)),
+                error_rate=float(kwargs.get('bloom_error', 0.01)))
+            self.bloom_stale = self.bloom.load()
 
     def _keyPrefix(self, key):
         """Get the prefix, if available for a key, to reference as a dir
@@ -44,9 +108,11 @@ class NamespacedBrain(dict):
         """
         if '_' in key:
             part = key.split('_')[0]
-            possdir = os.path.join(self.braindir, part)
-            if not os.path.exists(possdir):
-                os.mkdir(possdir)
+            if part not in self._dirs:
+                possdir = os.path.join(self.braindir, part)
+                if not os.path.exists(possdir):
+                    os.mkdir(possdir)
+                self._dirs.add(part)
             return part
         else:
             return ''
@@ -76,16 +142,527 @@ class NamespacedBrain(dict):
         return os.path.join(self.braindir, self._keyPrefix(key),
             self._namespace(key))
 
-    def cacheItem(self, key, val):
-        """Cache a value
+    def _loadBucket(self, fn):
+        """Read and decode a whole bucket file, skipping the bucket cache
+        
+        Args:
+            fn (str): path to the bucket file
+        
+        Returns:
+            dict: the bucket contents, empty if there's no file yet
+        """
+        if not os.path.exists(fn):
+            return {}
+        with open(fn, 'r') as f:
+            return json.loads(f.read())
+
+    def _dumpBucket(self, fn, contents):
+        """Encode and write a whole bucket file, skipping the bucket cache
+        
+        Args:
+            fn (str): path to the bucket file
+            contents (dict): the bucket contents
+        """
+        with open(fn, 'w') as out:
+            out.write(json.dumps(contents))
+
+    def _signature(self, fn):
+        """Cheap fingerprint of a bucket file to tell if it changed
+        
+        Args:
+            fn (str): path to the bucket file
+        
+        Returns:
+            tuple: (mtime, size), or None if there's no file
+        """
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _rememberBucket(self, fn, sig, contents):
+        """Keep a decoded bucket in memory. Callers must hold the lock.
+        
+        Args:
+            fn (str): path to the bucket file
+            sig (tuple): the file signature the contents match
+            contents (dict): the bucket contents
+        """
+        self.buckets[fn] = (sig, contents)
+        self.buckets.move_to_end(fn)
+        while len(self.buckets) > self.bucket_cache:
+            self.buckets.popitem(last=False)
+
+    def _readBucket(self, fn):
+        """Get a decoded bucket, parsing the file only if it changed since it
+        was last read. The returned dict is shared, so copy it before changing
+        it anywhere but _writeBucket.
+        
+        Args:
+            fn (str): path to the bucket file
+        
+        Returns:
+            dict: the bucket contents, empty if there's no file yet
+        """
+        with self._lock:
+            if fn in self._dirty:
+                return self._dirty[fn]
+            if fn in self._flushing:
+                return self._flushing[fn]
+            sig = self._signature(fn)
+            if sig is None:
+                self.buckets.pop(fn, None)
+                return {}
+            cached = self.buckets.get(fn)
+            if cached is not None and cached[0] == sig:
+                self.buckets.move_to_end(fn)
+                return cached[1]
+            contents = self._loadBucket(fn)
+            self._rememberBucket(fn, sig, contents)
+            return contents
+
+    def _writeBucket(self, fn, contents):
+        """Encode and write a whole bucket file
+        
+        Args:
+            fn (str): path to the bucket file
+            contents (dict): the bucket contents
+        """
+        with self._lock:
+            self.buckets.pop(fn, None)
+            self._dumpBucket(fn, contents)
+            self._rememberBucket(fn, self._signature(fn), contents)
+
+    def _updateBucket(self, fn, updates, removals=()):
+        """Apply writes and removals to one bucket with a single rewrite
+        
+        Args:
+            fn (str): path to the bucket file
+            updates (dict): keys and values to write
+            removals (list, optional): keys to remove
+        """
+        with self._lock:
+            deferred = self.write_behind and not self._closing
+            if deferred:
+                if fn not in self._dirty:
+                    self._dirty[fn] = dict(self._readBucket(fn))
+                    self._startFlusher()
+                contents = self._dirty[fn]
+            else:
+                contents = dict(self._readBucket(fn))
+            contents.update(updates)
+            for key in removals:
+                contents.pop(key, None)
+            if not deferred:
+                self._writeBucket(fn, contents)
+
+    def _startFlusher(self):
+        """Start the write-behind flusher thread if it isn't running. Callers
+        must hold the lock.
+        """
+        if self._flushThread is None and not self._closing:
+            self._flushThread = threading.Thread(target=self._flushLoop,
+                daemon=True)
+            self._flushThread.start()
+
+    def _flushLoop(self):
+        """Write-behind flusher thread"""
+        while not self._closing:
+            self._flushWake.wait(self.flush_interval)
+            self._flushWake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every dirty bucket to disk. Buckets stay readable from memory
+        while they're being written, and writes that land during a flush are
+        picked up by the next one.
+        """
+        with self._flushLock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._flushing, self._dirty = self._dirty, {}
+            for fn, contents in list(self._flushing.items()):
+                tmp = fn + '.tmp'
+                try:
+                    self._dumpBucket(tmp, contents)
+                    os.replace(tmp, fn)
+                except (IOError, OSError) as e:
+                    print(e)
+                    with self._lock:
+                        # try again next time, unless it was written since
+                        self._dirty.setdefault(fn, contents)
+                        del self._flushing[fn]
+                    continue
+                with self._lock:
+                    self._rememberBucket(fn, self._signature(fn), contents)
+                    del self._flushing[fn]
+                    self.flushes += 1
+
+    def _ttl(self, key):
+        """Get the TTL for a key's namespace
+        
+        Args:
+            key (str): key!
+        
+        Returns:
+            float: TTL in seconds, or None if the namespace doesn't expire
+        """
+        return self.ttls.get(key.split('_')[0])
+
+    def _expired(self, key, contents, now=None):
+        """Has a key outlived its namespace's TTL? Entries written before the
+        TTL was set have no write time and count as fresh until the sweeper
+        stamps them.
+        
+        Args:
+            key (str): key!
+            contents (dict): the bucket the key is in
+            now (float, optional): current time
+        
+        Returns:
+            bool: yep
+        """
+        ttl = self._ttl(key)
+        if ttl is None:
+            return False
+        stamp = contents.get(STAMP_PREFIX + key)
+        if stamp is None:
+            return False
+        return (now or time.time()) - stamp > ttl
+
+    def _sweepBucket(self, fn, now):
+        """Remove expired entries from one bucket, and stamp entries that
+        don't have a write time yet so they expire one TTL from now
+        
+        Args:
+            fn (str): path to the bucket file
+            now (float): current time
+        
+        Returns:
+            tuple: (entries removed, approximate bytes reclaimed)
+        """
+        with self._lock:
+            contents = self._peekBucket(fn)
+            updates = {}
+            removals = []
+            reclaimed = 0
+            for key, val in contents.items():
+                if key.startswith(STAMP_PREFIX) or self._ttl(key) is None:
+                    continue
+                if STAMP_PREFIX + key not in contents:
+                    updates[STAMP_PREFIX + key] = now
+                elif self._expired(key, contents, now):
+                    removals.extend([key, STAMP_PREFIX + key])
+                    reclaimed += len(json.dumps({key: val}))
+            if updates or removals:
+                self._updateBucket(fn, updates, removals)
+        return (len(removals) // 2, reclaimed)
+
+    def _sweepPaths(self):
+        """Every bucket in a namespace with a TTL
+        
+        Yields:
+            str: path to a bucket file
+        """
+        for namespace in sorted(self.ttls):
+            for fn in self._bucketPaths(namespace + '_'):
+                yield fn
+
+    def sweep(self, budget=32):
+        """Remove expired entries, visiting at most budget buckets. Each call
+        picks up where the last one left off, so calling this regularly walks
+        every namespace with a TTL without ever pausing on the whole store.
+        
+        Args:
+            budget (int, optional): most buckets to visit
+        
+        Returns:
+            tuple: (entries removed, approximate bytes reclaimed)
+        """
+        entries = 0
+        reclaimed = 0
+        if not self.ttls:
+            return (entries, reclaimed)
+        if self._sweepCursor is None:
+            self._sweepCursor = self._sweepPaths()
+        for _ in range(budget):
+            fn = next(self._sweepCursor, None)
+            if fn is None:
+                self._sweepCursor = None
+                break
+            removed, size = self._sweepBucket(fn, time.time())
+            entries += removed
+            reclaimed += size
+        self.swept_entries += entries
+        self.swept_bytes += reclaimed
+        return (entries, reclaimed)
+
+    def _bucketName(self, filename):
+        """Map a file in a namespace directory to the bucket it belongs to
+        
+        Args:
+            filename (str): name of a file in a namespace directory
+        
+        Returns:
+            str: the bucket name, or None if the file isn't a bucket
+        """
+        if filename.endswith('.tmp'):
+            return None
+        return filename
+
+    def _bucketExists(self, fn):
+        """Is there anything stored for a bucket?
+        
+        Args:
+            fn (str): path to the bucket file
+        
+        Returns:
+            bool: yep
+        """
+        return fn in self._dirty or os.path.exists(fn)
+
+    def _peekBucket(self, fn):
+        """Get a bucket's contents for a scan without pushing hot buckets out
+        of the bucket cache
+        
+        Args:
+            fn (str): path to the bucket file
+        
+        Returns:
+            dict: the bucket contents
+        """
+        with self._lock:
+            if fn in self._dirty:
+                return self._dirty[fn]
+            if fn in self._flushing:
+                return self._flushing[fn]
+            cached = self.buckets.get(fn)
+            if cached is not None and cached[0] == self._signature(fn):
+                return cached[1]
+        return self._loadBucket(fn)
+
+    def _bucketPaths(self, prefix):
+        """Find the buckets that can hold keys starting with prefix, using the
+        directory and bucket naming instead of opening anything
+        
+        Args:
+            prefix (str): key prefix
+        
+        Yields:
+            str: path to a bucket file
+        """
+        if '_' in prefix:
+            part, rest = prefix.split('_', 1)
+            parts = [part]
+            second = rest.split('_')[0][:4]
+            if '_' in rest:
+                # the second part of the key is complete, so there's exactly
+                # one bucket it can be in
+                fn = os.path.join(self.braindir, part, '%s_%s' % (part, second))
+                if self._bucketExists(fn):
+                    yield fn
+                return
+        else:
+            parts = sorted(d for d in os.listdir(self.braindir)
+                if d.startswith(prefix) and
+                    os.path.isdir(os.path.join(self.braindir, d)))
+            second = None
+        for part in parts:
+            dirpath = os.path.join(self.braindir, part)
+            if not os.path.isdir(dirpath):
+                continue
+            seen = set()
+            for entry in os.scandir(dirpath):
+                name = self._bucketName(entry.name)
+                if name is None or name in seen:
+                    continue
+                if second is not None and \
+                        not name.partition('_')[2].startswith(second):
+                    continue
+                seen.add(name)
+                yield os.path.join(dirpath, name)
+
+    def scan(self, prefix=''):
+        """Lazily iterate over everything stored under a key prefix. Only the
+        buckets that can hold matching keys are read, one at a time.
+        
+        Args:
+            prefix (str, optional): key prefix
+        
+        Yields:
+            tuple: (key, value)
+        """
+        if self.write_behind:
+            # new buckets only show up in the directory listing once written
+            self.flush()
+        for fn in self._bucketPaths(prefix):
+            contents = self._peekBucket(fn)
+            now = time.time()
+            for key, val in list(contents.items()):
+                if key.startswith(prefix) and \
+                        not key.startswith(STAMP_PREFIX) and \
+                        not self._expired(key, contents, now):
+                    yield key, val
+
+    def count(self, prefix=''):
+        """Count the keys under a prefix
+        
+        Args:
+            prefix (str, optional): key prefix
+        
+        Returns:
+            int: how many
+        """
+        return sum(1 for _ in self.scan(prefix))
+
+    def keys(self):
+        """Lazily iterate over every key
+        
+        Yields:
+            str: key
+        """
+        for key, _ in self.scan():
+            yield key
+
+    def items(self):
+        """Lazily iterate over every key and value
+        
+        Returns:
+            generator: (key, value) tuples
+        """
+        return self.scan()
+
+    def __iter__(self):
+        return self.keys()
+
+    def close(self):
+        """Stop the write-behind flusher and write out anything still dirty"""
+        self._closing = True
+        if self._flushThread is not None:
+            self._flushWake.set()
+            self._flushThread.join()
+            self._flushThread = None
+        self.flush()
+        if self.bloom is not None:
+            self.bloom.save()
+
+    def rebuild_bloom(self, namespaces=None, background=False):
+        """Rebuild Bloom filters from a scan of the brain
+        
+        Args:
+            namespaces (list, optional): which namespaces, defaults to all
+                the filtered ones
+            background (bool, optional): scan on a separate thread
+        
+        Returns:
+            Thread: the rebuild thread if background, otherwise None
+        """
+        if self.bloom is None:
+            return None
+        if not background:
+            self.bloom.rebuild(self, namespaces)
+            return None
+        thread = threading.Thread(target=self.bloom.rebuild,
+            args=(self, namespaces), daemon=True)
+        thread.start()
+        return thread
+
+    def cacheItem(self, key, val, written=None):
+        """Cache a value, until it expires if its namespace has a TTL
         
         Args:
             key (str): key!
             val (str): value!
+            written (float, optional): when it was written, defaults to now
+        """
+        ttl = self._ttl(key)
+        self.cache.put(key, val,
+            None if ttl is None else (written or time.time()) + ttl)
+
+    def _bucketsFor(self, keys):
+        """Group keys by the bucket file they live in
+        
+        Args:
+            keys (iterable): keys!
+        
+        Returns:
+            OrderedDict: bucket path -> list of keys
+        """
+        grouped = collections.OrderedDict()
+        for key in keys:
+            grouped.setdefault(self._keyPath(key), []).append(key)
+        return grouped
+
+    def get_many(self, keys, stale=False):
+        """Look up several keys, reading each bucket they touch once
+        
+        Args:
+            keys (iterable): keys!
+            stale (bool, optional): also return entries past their TTL that
+                the sweeper hasn't removed yet
+        
+        Returns:
+            dict: key -> value for the keys that are stored
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            if self.useCache:
+                val = self.cache.get(key)
+                if val is not MISSING:
+                    found[key] = val
+                    continue
+            if self.bloom is None or self.bloom.might_contain(key):
+                missing.append(key)
+        now = time.time()
+        for fn, bucket_keys in self._bucketsFor(missing).items():
+            contents = self._readBucket(fn)
+            for key in bucket_keys:
+                if key not in contents:
+                    continue
+                expired = self._expired(key, contents, now)
+                if stale or not expired:
+                    found[key] = contents[key]
+                if self.useCache and not expired:
+                    self.cacheItem(key, contents[key],
+                        contents.get(STAMP_PREFIX + key))
+        return found
+
+    def contains_many(self, keys):
+        """Membership test for several keys, reading each bucket once
+        
+        Args:
+            keys (iterable): keys!
+        
+        Returns:
+            dict: key -> bool
+        """
+        keys = list(keys)
+        found = self.get_many(keys)
+        return dict((key, key in found) for key in keys)
+
+    def set_many(self, mapping):
+        """Store several keys, writing each bucket they touch once
+        
+        Args:
+            mapping (dict): key -> value
         """
-        self.cache[key] = val
-        if len(self.cache) > 50:
-            self.cache.pop(list(self.cache.keys())[-1], None)        
+        now = time.time()
+        for fn, bucket_keys in self._bucketsFor(mapping).items():
+            updates = {}
+            for key in bucket_keys:
+                updates[key] = mapping[key]
+                if self._ttl(key) is not None:
+                    updates[STAMP_PREFIX + key] = now
+            self._updateBucket(fn, updates)
+        if self.bloom is not None:
+            for key in mapping:
+                self.bloom.add(key)
+        if self.useCache:
+            for key, val in mapping.items():
+                self.cacheItem(key, val, now)
 
     def __getitem__(self, key):
         """Override __getitem__
@@ -99,14 +676,18 @@ class NamespacedBrain(dict):
         Raises:
             KeyError: Adhering to dict behavior
         """
-        if self.useCache and key in self.cache:
-            return self.cache[key]
-        fn = self._keyPath(key)
-        if not os.path.exists(fn):
+        if self.useCache:
+            val = self.cache.get(key)
+            if val is not MISSING:
+                return val
+        if self.bloom is not None and not self.bloom.might_contain(key):
+            raise KeyError('Key not found')
+        contents = self._readBucket(self._keyPath(key))
+        if key not in contents or self._expired(key, contents):
             raise KeyError('Key not found')
-        val = json.loads(open(fn, 'r').read())[key]
+        val = contents[key]
         if self.useCache:
-            self.cacheItem(key, val)
+            self.cacheItem(key, val, contents.get(STAMP_PREFIX + key))
         return val
 
     def __setitem__(self, key, val):
@@ -116,17 +697,31 @@ class NamespacedBrain(dict):
             key (str): key!
             val (str): value
         """
+        updates = {key: val}
+        if self._ttl(key) is not None:
+            updates[STAMP_PREFIX + key] = time.time()
+        self._updateBucket(self._keyPath(key), updates)
+        if self.bloom is not None:
+            self.bloom.add(key)
+        if self.useCache:
+            self.cacheItem(key, val, updates.get(STAMP_PREFIX + key))
+
+    def __delitem__(self, key):
+        """__delitem__ implementation
+        
+        Args:
+            key (str): key!
+        
+        Raises:
+            KeyError: Adhering to dict behavior
+        """
         fn = self._keyPath(key)
-        if os.path.exists(fn):
-            contents = json.loads(open(fn, 'r').read())
-            contents[key] = val
-        else:
-            contents = {key: val}
-        out = open(fn, 'w')
-        out.write(json.dumps(contents))
-        out.close()
+        with self._lock:
+            if key not in self._readBucket(fn):
+                raise KeyError('Key not found')
+            self._updateBucket(fn, {}, [key, STAMP_PREFIX + key])
         if self.useCache:
-            self.cacheItem(key, val)
+            self.cache.pop(key)
 
     def __contains__(self, key):
         """__contains__ implementation
@@ -137,7 +732,14 @@ class NamespacedBrain(dict):
         Returns:
             bool: if it's contained!
         """
-        fn = self._keyPath(key)
-        return (self.useCache and key in self.cache) or \
-            (os.path.exists(fn) and key in json.loads(open(fn, 'r').read()))
+        if self.useCache and self.cache.get(key) is not MISSING:
+            return True
+        if self.bloom is not None and not self.bloom.might_contain(key):
+            return False
+        contents = self._readBucket(self._keyPath(key))
+        if key not in contents or self._expired(key, contents):
+            return False
+        if self.useCache:
+            self.cacheItem(key, contents[key], contents.get(STAMP_PREFIX + key))
+        return True
 
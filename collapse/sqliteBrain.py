@@ -0,0 +1,482 @@
+import json
+import os
+import sqlite3
+import threading
+import contextlib
+import time
+from collapse.lruCache import LRUCache, MISSING
+from collapse.bloomFilter import BloomIndex
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS brain ' \
+    '(key TEXT PRIMARY KEY, value TEXT NOT NULL, written REAL) WITHOUT ROWID'
+ADD_WRITTEN = 'ALTER TABLE brain ADD COLUMN written REAL'
+WRITTEN_INDEX = 'CREATE INDEX IF NOT EXISTS brain_written ON brain (written) ' \
+    'WHERE written IS NOT NULL'
+SELECT = 'SELECT value, written FROM brain WHERE key = ?'
+UPSERT = 'INSERT OR REPLACE INTO brain (key, value, written) VALUES (?, ?, ?)'
+DELETE = 'DELETE FROM brain WHERE key = ?'
+SELECT_MANY = 'SELECT key, value, written FROM brain WHERE key IN (%s)'
+SCAN = 'SELECT key, value, written FROM brain ' \
+    'WHERE key >= ? AND key < ? ORDER BY key'
+SCAN_ALL = 'SELECT key, value, written FROM brain ORDER BY key'
+EXPIRED = 'SELECT key, length(key) + length(value) FROM brain ' \
+    'INDEXED BY brain_written WHERE written < ? AND key >= ? AND key < ? ' \
+    'LIMIT ?'
+STAMP = 'UPDATE brain SET written = ? ' \
+    'WHERE written IS NULL AND key >= ? AND key < ?'
+COUNT = 'SELECT COUNT(*) FROM brain WHERE key >= ? AND key < ?'
+COUNT_ALL = 'SELECT COUNT(*) FROM brain'
+
+
+class SqliteBrain(dict):
+    """SqliteBrain is a drop-in replacement for NamespacedBrain that keeps
+    everything in a single indexed SQLite file instead of a tree of bucket
+    files. The database runs in WAL mode so readers never wait on the writer.
+    Each thread reads through its own connection, and all writes go through
+    one shared connection behind a lock.
+
+    Values are stored JSON encoded, same as the flat file store. Rows in
+    namespaces with a TTL record when they were written, and read as missing
+    once they're older than that until sweep() deletes them. Rows written
+    before their namespace had a TTL are stamped when the brain is opened,
+    so they expire one TTL later. Namespaces can
+    get Bloom filters the same way as with NamespacedBrain.
+
+    Attributes:
+        bloom (BloomIndex): Bloom filters, None if there are none
+        bloom_stale (list): namespaces whose filter needs a rebuild
+        braindir (str): storage location
+        cache (LRUCache): in-memory cache
+        path (str): the database file
+        swept_bytes (int): approximate bytes of expired rows removed
+        swept_entries (int): expired rows removed
+        ttls (dict): namespace -> TTL in seconds
+        useCache (bool): use an in-memory cache?
+    """
+
+    def __init__(self, *args, **kwargs):
+        """constructor
+
+        Args:
+            *args: Not used, but passed to dict
+            **kwargs: 'braindir', 'path', 'cache', 'cache_entries',
+                'cache_bytes', 'cache_limits', 'ttls', 'bloom_namespaces',
+                'bloom_capacity' and 'bloom_error' checked
+        """
+        super(SqliteBrain, self).__init__()
+        self.braindir = kwargs.get('braindir', os.path.join(
+            os.path.expanduser('~'), '.collapseBrain'))
+        if not os.path.exists(self.braindir):
+            os.mkdir(self.braindir)
+        self.path = kwargs.get('path') or \
+            os.path.join(self.braindir, 'brain.sqlite3')
+        self.useCache = 'cache' in kwargs and kwargs['cache']
+        if self.useCache:
+            self.cache = LRUCache(
+                max_entries=kwargs.get('cache_entries', 50),
+                max_bytes=kwargs.get('cache_bytes'),
+                namespace_limits=kwargs.get('cache_limits'))
+        self.ttls = dict(kwargs.get('ttls') or {})
+        self.swept_entries = 0
+        self.swept_bytes = 0
+        self._local = threading.local()
+        self._writeLock = threading.RLock()
+        self._batchDepth = 0
+        self._batchOwner = None
+        self._batchKeys = set()
+        self._writer = self._connect()
+        self._writer.execute(SCHEMA)
+        columns = [row[1] for row in
+            self._writer.execute('PRAGMA table_info(brain)')]
+        if 'written' not in columns:
+            self._writer.execute(ADD_WRITTEN)
+        self._writer.execute(WRITTEN_INDEX)
+        now = time.time()
+        for namespace in self.ttls:
+            # done once here so sweep() only ever walks the written index
+            self._writer.execute(STAMP,
+                (now,) + self._prefixRange(namespace + '_'))
+        self._writer.commit()
+        self.bloom = None
+        self.bloom_stale = []
+        if kwargs.get('bloom_namespaces'):
+            self.bloom = BloomIndex(self.braindir, kwargs['bloom_namespaces'],
+                capacity=int(kwargs.get('bloom_capacity', 500000)),
+                error_rate=float(kwargs.get('bloom_error', 0.01)))
+            self.bloom_stale = self.bloom.load()
+
+    def _connect(self):
+        """Open a connection with the pragmas every connection needs
+
+        Returns:
+            sqlite3.Connection: connection
+        """
+        conn = sqlite3.connect(self.path, timeout=10.0,
+            check_same_thread=False, isolation_level='DEFERRED')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self):
+        """Get the connection the current thread should read with. A thread
+        in the middle of a batch reads through the writer so it sees its own
+        uncommitted writes.
+
+        Returns:
+            sqlite3.Connection: connection
+        """
+        if self._batchOwner == threading.get_ident():
+            return self._writer
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group every write made in the block into a single transaction
+
+        Yields:
+            SqliteBrain: self
+        """
+        with self._writeLock:
+            self._batchDepth += 1
+            self._batchOwner = threading.get_ident()
+            try:
+                yield self
+            except BaseException:
+                if self._batchDepth == 1:
+                    self._writer.rollback()
+                    if self.useCache:
+                        # values written in the block were cached as they
+                        # went, and were never committed
+                        for key in self._batchKeys:
+                            self.cache.pop(key)
+                raise
+            else:
+                if self._batchDepth == 1:
+                    self._writer.commit()
+            finally:
+                self._batchDepth -= 1
+                if self._batchDepth == 0:
+                    self._batchOwner = None
+                    self._batchKeys.clear()
+
+    def _touched(self, keys):
+        """Note keys written inside a batch so a rollback can drop them from
+        the cache, callers must hold the write lock
+
+        Args:
+            keys (iterable): keys!
+        """
+        if self._batchDepth:
+            self._batchKeys.update(keys)
+
+    def close(self):
+        """Commit anything outstanding and close the writer connection"""
+        with self._writeLock:
+            self._writer.commit()
+            self._writer.close()
+        if self.bloom is not None:
+            self.bloom.save()
+
+    def rebuild_bloom(self, namespaces=None, background=False):
+        """Rebuild Bloom filters from a scan of the brain
+
+        Args:
+            namespaces (list, optional): which namespaces, defaults to all
+                the filtered ones
+            background (bool, optional): scan on a separate thread
+
+        Returns:
+            Thread: the rebuild thread if background, otherwise None
+        """
+        if self.bloom is None:
+            return None
+        if not background:
+            self.bloom.rebuild(self, namespaces)
+            return None
+        thread = threading.Thread(target=self.bloom.rebuild,
+            args=(self, namespaces), daemon=True)
+        thread.start()
+        return thread
+
+    def _ttl(self, key):
+        """Get the TTL for a key's namespace
+
+        Args:
+            key (str): key!
+
+        Returns:
+            float: TTL in seconds, or None if the namespace doesn't expire
+        """
+        return self.ttls.get(key.split('_')[0])
+
+    def _expired(self, key, written, now=None):
+        """Has a row outlived its namespace's TTL?
+
+        Args:
+            key (str): key!
+            written (float): when the row was written, None if unknown
+            now (float, optional): current time
+
+        Returns:
+            bool: yep
+        """
+        ttl = self._ttl(key)
+        if ttl is None or written is None:
+            return False
+        return (now or time.time()) - written > ttl
+
+    def sweep(self, budget=256):
+        """Delete expired rows, at most budget per namespace. The written
+        index keeps each call from touching live rows.
+
+        Args:
+            budget (int, optional): most rows to delete per namespace
+
+        Returns:
+            tuple: (entries removed, approximate bytes reclaimed)
+        """
+        entries = 0
+        reclaimed = 0
+        now = time.time()
+        with self._writeLock:
+            for namespace, ttl in sorted(self.ttls.items()):
+                low, high = self._prefixRange(namespace + '_')
+                rows = self._writer.execute(EXPIRED,
+                    (now - ttl, low, high, budget)).fetchall()
+                self._writer.executemany(DELETE, [(row[0],) for row in rows])
+                entries += len(rows)
+                reclaimed += sum(row[1] for row in rows)
+            if self._batchDepth == 0:
+                self._writer.commit()
+        self.swept_entries += entries
+        self.swept_bytes += reclaimed
+        return (entries, reclaimed)
+
+    def _prefixRange(self, prefix):
+        """Turn a key prefix into an index range
+
+        Args:
+            prefix (str): key prefix
+
+        Returns:
+            tuple: (lowest key, first key past the prefix)
+        """
+        return (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+    def scan(self, prefix=''):
+        """Lazily iterate over everything stored under a key prefix, using the
+        primary key index
+
+        Args:
+            prefix (str, optional): key prefix
+
+        Yields:
+            tuple: (key, value)
+        """
+        if prefix:
+            cursor = self._reader().execute(SCAN, self._prefixRange(prefix))
+        else:
+            cursor = self._reader().execute(SCAN_ALL)
+        now = time.time()
+        for key, value, written in cursor:
+            if not self._expired(key, written, now):
+                yield key, json.loads(value)
+
+    def count(self, prefix=''):
+        """Count the keys under a prefix
+
+        Args:
+            prefix (str, optional): key prefix
+
+        Returns:
+            int: how many
+        """
+        if self.ttls:
+            # expired rows still in the table mustn't be counted
+            return sum(1 for _ in self.scan(prefix))
+        if prefix:
+            row = self._reader().execute(COUNT,
+                self._prefixRange(prefix)).fetchone()
+        else:
+            row = self._reader().execute(COUNT_ALL).fetchone()
+        return row[0]
+
+    def keys(self):
+        """Lazily iterate over every key
+
+        Yields:
+            str: key
+        """
+        for key, _ in self.scan():
+            yield key
+
+    def items(self):
+        """Lazily iterate over every key and value
+
+        Returns:
+            generator: (key, value) tuples
+        """
+        return self.scan()
+
+    def __iter__(self):
+        return self.keys()
+
+    def cacheItem(self, key, val, written=None):
+        """Cache a value, until it expires if its namespace has a TTL
+
+        Args:
+            key (str): key!
+            val (str): value!
+            written (float, optional): when it was written, defaults to now
+        """
+        ttl = self._ttl(key)
+        self.cache.put(key, val,
+            None if ttl is None else (written or time.time()) + ttl)
+
+    def get_many(self, keys, stale=False):
+        """Look up several keys with one query per 500 keys
+
+        Args:
+            keys (iterable): keys!
+            stale (bool, optional): also return rows past their TTL that
+                the sweeper hasn't removed yet
+
+        Returns:
+            dict: key -> value for the keys that are stored
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            if self.useCache:
+                val = self.cache.get(key)
+                if val is not MISSING:
+                    found[key] = val
+                    continue
+            if self.bloom is None or self.bloom.might_contain(key):
+                missing.append(key)
+        now = time.time()
+        # stay well under SQLite's bound parameter limit
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            query = SELECT_MANY % ', '.join('?' * len(chunk))
+            for key, value, written in self._reader().execute(query, chunk):
+                expired = self._expired(key, written, now)
+                if stale or not expired:
+                    found[key] = json.loads(value)
+                if self.useCache and not expired:
+                    self.cacheItem(key, found[key], written)
+        return found
+
+    def contains_many(self, keys):
+        """Membership test for several keys
+
+        Args:
+            keys (iterable): keys!
+
+        Returns:
+            dict: key -> bool
+        """
+        keys = list(keys)
+        found = self.get_many(keys)
+        return dict((key, key in found) for key in keys)
+
+    def set_many(self, mapping):
+        """Store several keys in a single transaction
+
+        Args:
+            mapping (dict): key -> value
+        """
+        now = time.time()
+        rows = [(key, json.dumps(val),
+            now if self._ttl(key) is not None else None)
+            for key, val in mapping.items()]
+        with self.batch():
+            self._touched(mapping)
+            self._writer.executemany(UPSERT, rows)
+        if self.bloom is not None:
+            for key in mapping:
+                self.bloom.add(key)
+        if self.useCache:
+            for key, val in mapping.items():
+                self.cacheItem(key, val, now)
+
+    def __getitem__(self, key):
+        """Override __getitem__
+
+        Args:
+            key (str): key!
+
+        Returns:
+            str: value!
+
+        Raises:
+            KeyError: Adhering to dict behavior
+        """
+        if self.useCache:
+            val = self.cache.get(key)
+            if val is not MISSING:
+                return val
+        if self.bloom is not None and not self.bloom.might_contain(key):
+            raise KeyError('Key not found')
+        row = self._reader().execute(SELECT, (key,)).fetchone()
+        if row is None or self._expired(key, row[1]):
+            raise KeyError('Key not found')
+        val = json.loads(row[0])
+        if self.useCache:
+            self.cacheItem(key, val, row[1])
+        return val
+
+    def __setitem__(self, key, val):
+        """__setitem__ implementation
+
+        Args:
+            key (str): key!
+            val (str): value
+        """
+        written = time.time() if self._ttl(key) is not None else None
+        with self._writeLock:
+            self._touched([key])
+            self._writer.execute(UPSERT, (key, json.dumps(val), written))
+            if self._batchDepth == 0:
+                self._writer.commit()
+        if self.bloom is not None:
+            self.bloom.add(key)
+        if self.useCache:
+            self.cacheItem(key, val, written)
+
+    def __delitem__(self, key):
+        """__delitem__ implementation
+
+        Args:
+            key (str): key!
+
+        Raises:
+            KeyError: Adhering to dict behavior
+        """
+        with self._writeLock:
+            if self._writer.execute(DELETE, (key,)).rowcount == 0:
+                raise KeyError('Key not found')
+            if self._batchDepth == 0:
+                self._writer.commit()
+        if self.useCache:
+            self.cache.pop(key)
+
+    def __contains__(self, key):
+        """__contains__ implementation
+
+        Args:
+            key (str): key!
+
+        Returns:
+            bool: if it's contained!
+        """
+        if self.useCache and self.cache.get(key) is not MISSING:
+            return True
+        if self.bloom is not None and not self.bloom.might_contain(key):
+            return False
+        row = self._reader().execute(SELECT, (key,)).fetchone()
+        return row is not None and not self._expired(key, row[1])
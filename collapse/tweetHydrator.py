@@ -0,0 +1,90 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class TweetHydrator(object):
+    """Fetches tweets in bulk. Every tweet id asked for within a short window,
+    by any thread, goes out in the same lookup call, up to batch_size ids a
+    call. The first caller in a window makes the calls; everyone else just
+    waits for their tweets.
+
+    Attributes:
+        batch_size (int): most ids in one lookup call
+        fetched (int): tweet ids sent to lookup
+        lookups (int): lookup calls made
+        window (float): seconds to wait for more ids before a lookup
+    """
+
+    def __init__(self, lookup, window=0.05, batch_size=100):
+        """constructor
+
+        Args:
+            lookup (callable): takes a list of tweet ids, returns the
+                statuses that exist
+            window (float, optional): seconds to wait for more ids
+            batch_size (int, optional): most ids in one lookup call
+        """
+        self._lookup = lookup
+        self.window = window
+        self.batch_size = batch_size
+        self.lookups = 0
+        self.fetched = 0
+        self._pending = {}
+        self._leading = False
+        self._lock = threading.Lock()
+
+    def _drain(self):
+        """Look up everything pending, a batch at a time, until nothing's
+        left. Only one thread runs this at once."""
+        time.sleep(self.window)
+        while True:
+            with self._lock:
+                batch = list(self._pending.items())[:self.batch_size]
+                for tweet_id, _ in batch:
+                    del self._pending[tweet_id]
+                if not batch:
+                    self._leading = False
+                    return
+            self.lookups += 1
+            self.fetched += len(batch)
+            try:
+                statuses = self._lookup([tweet_id for tweet_id, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            found = dict((status.id_str, status) for status in statuses)
+            for tweet_id, future in batch:
+                future.set_result(found.get(tweet_id))
+
+    def fetch(self, tweet_ids):
+        """Get some tweets, batched with whatever else is asked for around
+        the same time
+
+        Args:
+            tweet_ids (list): tweet ids
+
+        Returns:
+            dict: str tweet id -> status, for the tweets that exist
+
+        Raises:
+            Exception: whatever lookup raised for this batch
+        """
+        futures = {}
+        with self._lock:
+            for tweet_id in tweet_ids:
+                tweet_id = str(tweet_id)
+                if tweet_id not in self._pending:
+                    self._pending[tweet_id] = Future()
+                futures[tweet_id] = self._pending[tweet_id]
+            lead = not self._leading
+            self._leading = True
+        if lead:
+            self._drain()
+        statuses = {}
+        for tweet_id, future in futures.items():
+            status = future.result()
+            if status is not None:
+                statuses[tweet_id] = status
+        return statuses
@@ -0,0 +1,216 @@
+import copy
+import math
+import threading
+import time
+import tweepy
+
+# tweepy method -> the rate limit family twitter counts it against
+FAMILIES = {
+    'get_status': 'statuses/show',
+    'statuses_lookup': 'statuses/lookup',
+    'me': 'account/verify_credentials',
+    'update_status': 'statuses/update',
+    'destroy_status': 'statuses/destroy',
+    'media_upload': 'media/upload'
+}
+# calls someone asked for from irc, which jump ahead of reads
+WRITES = ('update_status', 'destroy_status', 'media_upload')
+
+
+class Throttled(tweepy.TweepError):
+    """Raised instead of making a call that's out of rate limit budget.
+    It's a TweepError so the usual handling reports it."""
+    pass
+
+
+class TwitterScheduler(object):
+    """Stands in front of a tweepy.API and spends its rate limit carefully.
+    Every call takes a token from a bucket that refills at rate per second;
+    reads leave write_reserve tokens behind for writes, and also stop once
+    twitter says their family has low_water calls left before the reset.
+    A read waits for budget only if it will have some within read_wait
+    seconds, writes within write_wait; otherwise Throttled is raised
+    straight away, without waiting, so callers can fall back to what's
+    cached. A family at its low water mark refuses reads at once until
+    the reset, unless that's within read_wait. The budget twitter reports
+    in the x-rate-limit-* headers is tracked per family, read from each
+    call's own response: calls run on a shallow copy of the API, since
+    tweepy keeps last_response on the API object. Methods other than the
+    ones in FAMILIES pass straight through.
+
+    Attributes:
+        api (tweepy.API): the real client
+        burst (int): token bucket size
+        deferred (int): reads that had to wait for budget
+        families (dict): family -> dict of limit, remaining and reset
+        low_water (int): calls left in a family below which reads stop
+        rate (float): tokens added per second
+        read_wait (float): longest a read waits for budget
+        throttled (int): calls refused for lack of budget
+        tokens (float): tokens in the bucket
+        write_reserve (int): tokens reads leave for writes
+        write_wait (float): longest a write waits for budget
+    """
+
+    def __init__(self, api, rate=1.0, burst=10, write_reserve=3, low_water=2,
+            read_wait=2.0, write_wait=10.0):
+        """constructor
+
+        Args:
+            api (tweepy.API): the real client
+            rate (float, optional): tokens added per second
+            burst (int, optional): token bucket size
+            write_reserve (int, optional): tokens reads leave for writes
+            low_water (int, optional): calls left in a family below which
+                reads stop until the reset
+            read_wait (float, optional): longest a read waits for budget
+            write_wait (float, optional): longest a write waits for budget
+        """
+        self.api = api
+        self.rate = rate
+        self.burst = burst
+        self.write_reserve = write_reserve
+        self.low_water = low_water
+        self.read_wait = read_wait
+        self.write_wait = write_wait
+        self.tokens = float(burst)
+        self.families = {}
+        self.throttled = 0
+        self.deferred = 0
+        self._refilled = time.time()
+        self._cond = threading.Condition()
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if name not in FAMILIES:
+            return attr
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def _refill(self, now):
+        """top up the token bucket, callers must hold the lock"""
+        self.tokens = min(self.burst,
+            self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _blocked(self, family, write, now):
+        """how long until a call may go, callers must hold the lock
+
+        Args:
+            family (str): its rate limit family
+            write (bool): is it a write
+            now (float): the time
+
+        Returns:
+            float: seconds, 0 if it may go now
+        """
+        wait = 0
+        need = 1 if write else 1 + self.write_reserve
+        if self.tokens < need:
+            wait = (need - self.tokens) / self.rate
+        budget = self.families.get(family)
+        if budget is not None and budget['reset'] > now and \
+                budget['remaining'] <= (0 if write else self.low_water):
+            wait = max(wait, budget['reset'] - now)
+        return wait
+
+    def _acquire(self, family, write):
+        """wait for budget for one call
+
+        Args:
+            family (str): its rate limit family
+            write (bool): is it a write
+
+        Raises:
+            Throttled: there won't be budget in time
+        """
+        deadline = time.time() + (self.write_wait if write else self.read_wait)
+        waited = False
+        with self._cond:
+            while True:
+                now = time.time()
+                self._refill(now)
+                wait = self._blocked(family, write, now)
+                if not wait:
+                    self.tokens -= 1
+                    return
+                if now + wait > deadline:
+                    self.throttled += 1
+                    raise Throttled('Rate limited, try again in %ds' % \
+                        math.ceil(wait))
+                if not write and not waited:
+                    self.deferred += 1
+                waited = True
+                self._cond.wait(wait)
+
+    def _record(self, family, api, limited=False):
+        """note what twitter said about a family's budget
+
+        Args:
+            family (str): its rate limit family
+            api (tweepy.API): the copy the call was made on
+            limited (bool, optional): the call came back 429
+        """
+        resp = getattr(api, 'last_response', None)
+        headers = resp.headers if resp is not None else {}
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        with self._cond:
+            budget = self.families.get(family)
+            if remaining is not None:
+                budget = self.families[family] = {
+                    'limit': int(headers.get('x-rate-limit-limit', 0)),
+                    'remaining': int(remaining),
+                    'reset': float(reset) if reset else time.time() + 900
+                }
+            if limited:
+                if budget is None:
+                    budget = self.families[family] = {'limit': 0}
+                budget['remaining'] = 0
+                budget['reset'] = max(budget.get('reset', 0), time.time() + 60)
+            self._cond.notify_all()
+
+    def call(self, name, *args, **kwargs):
+        """make a tweepy call once there's budget for it
+
+        Args:
+            name (str): the tweepy.API method
+            *args: passed to it
+            **kwargs: passed to it
+
+        Returns:
+            object: what it returned
+
+        Raises:
+            Throttled: out of budget, or twitter said so
+            TweepError: whatever tweepy raised
+        """
+        family = FAMILIES[name]
+        self._acquire(family, name in WRITES)
+        # so last_response is this call's, not one running alongside it
+        api = copy.copy(self.api)
+        try:
+            result = getattr(api, name)(*args, **kwargs)
+        except tweepy.RateLimitError as e:
+            self._record(family, api, limited=True)
+            self.throttled += 1
+            raise Throttled('Rate limited by twitter, try again later')
+        self._record(family, api)
+        return result
+
+    def status(self):
+        """the remaining budget, for reporting
+
+        Returns:
+            list: list of str
+        """
+        now = time.time()
+        with self._cond:
+            self._refill(now)
+            families = sorted(self.families.items())
+            tokens = self.tokens
+        return ['twitter budget: %.1f/%d tokens, %d throttled, %d deferred' % \
+                (tokens, self.burst, self.throttled, self.deferred)] + \
+            ['    %s: %s/%s left, resets in %ds' % (family,
+                budget['remaining'], budget['limit'] or '?',
+                max(0, budget['reset'] - now))
+            for family, budget in families]
@@ -0,0 +1,134 @@
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class PoolFull(Exception):
+    """Raised when a task can't be queued without waiting longer than the
+    submitter allows"""
+    pass
+
+
+class TaskHandle(Future):
+    """A Future for a task queued on a WorkerPool
+
+    Attributes:
+        tid (int): task id, unique for the life of the pool
+    """
+
+    def __init__(self, tid):
+        super(TaskHandle, self).__init__()
+        self.tid = tid
+
+
+class WorkerPool(object):
+    """A fixed set of worker threads fed from a bounded queue. When the queue
+    is full, submit() waits for room instead of piling up work, which pushes
+    back on whoever is producing it, or refuses the task straight away for
+    callers that mustn't block. The pool doesn't keep a reference to a
+    task once it's finished.
+
+    Attributes:
+        queue_size (int): how many tasks can wait for a worker
+        workers (int): number of worker threads
+    """
+
+    def __init__(self, workers=4, queue_size=64, name='collapse-worker'):
+        """constructor
+
+        Args:
+            workers (int, optional): number of worker threads
+            queue_size (int, optional): how many tasks can wait for a worker
+            name (str, optional): thread name prefix
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._ids = itertools.count(1)
+        self._threads = []
+        self._shutdown = False
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                name='%s-%d' % (name, i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        """Worker thread loop"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            handle, func, args, kwargs = item
+            # drop our reference before running so a long task doesn't keep
+            # the previous one alive
+            item = None
+            if not handle.set_running_or_notify_cancel():
+                continue
+            try:
+                handle.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                handle.set_exception(e)
+
+    def next_id(self):
+        """Reserve a task id without queueing anything
+
+        Returns:
+            int: task id
+        """
+        return next(self._ids)
+
+    def submit(self, func, args=[], kwargs={}, timeout=None, tid=None,
+            block=True):
+        """Queue a task
+
+        Args:
+            func (callable): what to run
+            args (list, optional): positional arguments
+            kwargs (dict, optional): keyword arguments
+            timeout (float, optional): how long to wait for room in the
+                queue, forever if None
+            tid (int, optional): a task id from next_id()
+            block (bool, optional): wait for room at all, if False a full
+                queue raises PoolFull right away
+
+        Returns:
+            TaskHandle: the task's handle
+
+        Raises:
+            PoolFull: the queue stayed full for the whole timeout, or was
+                full and block was False
+            RuntimeError: the pool is shut down
+        """
+        if self._shutdown:
+            raise RuntimeError('worker pool is shut down')
+        handle = TaskHandle(tid if tid is not None else self.next_id())
+        try:
+            self._queue.put((handle, func, args, kwargs), block=block,
+                timeout=timeout)
+        except queue.Full:
+            raise PoolFull('worker queue is full')
+        return handle
+
+    def pending(self):
+        """How many tasks are waiting for a worker
+
+        Returns:
+            int: tasks
+        """
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True):
+        """Stop the workers after the queued tasks are done
+
+        Args:
+            wait (bool, optional): join the worker threads
+        """
+        self._shutdown = True
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
@@ -15,7 +15,6 @@ setup(name='collapse',
           'irc==15.0.5',
           'tweepy',
           'requests',
-          'requests-futures',
           'unidecode',
           'Babel',
           'inotify'
@@ -0,0 +1,34 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from collapse.collapseCore import Collapse
+from collapse.sqliteBrain import SqliteBrain
+
+
+@pytest.fixture
+def make_collapse(tmp_path):
+    """Build a Collapse without touching twitter: just a brain on tmp_path,
+    the key locks and the url pool. Anything else a test needs (a fake
+    collapse_api, a hydrator, stubbed fetchers) is passed in as attributes.
+    """
+    made = []
+
+    def make(**attrs):
+        collapse = Collapse.__new__(Collapse)
+        collapse.settings = {}
+        collapse.insults = ['dork']
+        collapse.brain_lock = threading.Lock()
+        collapse.key_locks = [threading.Lock() for _ in range(64)]
+        collapse.brain = SqliteBrain(braindir=str(tmp_path), cache=True)
+        collapse.url_pool = ThreadPoolExecutor(max_workers=4)
+        for name, value in attrs.items():
+            setattr(collapse, name, value)
+        made.append(collapse)
+        return collapse
+
+    yield make
+    for collapse in made:
+        collapse.url_pool.shutdown()
+        collapse.brain.close()
@@ -0,0 +1,71 @@
+import threading
+import time
+
+SLOW = 1.0
+TOOT = 'https://mastodon.example/@slow/1'
+
+
+def slow_toot(started):
+    def process_toot(toot_url, updates=None):
+        if toot_url == TOOT:
+            started.set()
+            time.sleep(SLOW)
+        return ['toot ' + toot_url]
+    return process_toot
+
+
+def test_other_messages_proceed_during_slow_fetch(make_collapse):
+    started = threading.Event()
+    collapse = make_collapse(process_toot=slow_toot(started))
+    slow = threading.Thread(target=collapse.url, args=([TOOT], 'alice'))
+    began = time.time()
+    slow.start()
+    assert started.wait(SLOW)
+
+    messages = collapse.url(['https://mastodon.example/@quick/2'], 'bob')
+    assert messages == ['toot https://mastodon.example/@quick/2']
+    collapse.said('carol', 'hello')
+    assert collapse.brain['said_carol'] == 'hello'
+    assert time.time() - began < SLOW / 2
+
+    slow.join()
+    assert time.time() - began >= SLOW
+
+
+def test_same_url_bookkeeping_is_serialized(make_collapse):
+    collapse = make_collapse(process_toot=lambda url, updates=None: [])
+    get_many = collapse.brain.get_many
+    inside = []
+    overlap = []
+    lock = threading.Lock()
+
+    def slow_get_many(keys, stale=False):
+        keys = list(keys)
+        if not any(key.startswith('urls_') for key in keys):
+            return get_many(keys, stale)
+        with lock:
+            inside.append(1)
+            overlap.append(len(inside))
+        # give the other message every chance to get in
+        time.sleep(0.2)
+        found = get_many(keys, stale)
+        with lock:
+            inside.pop()
+        return found
+
+    collapse.brain.get_many = slow_get_many
+    url = 'https://example.com/same'
+    threads = [threading.Thread(target=collapse.url, args=([url], nick))
+        for nick in ('alice', 'bob')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(overlap) == 1
+    first = collapse.brain['firstpost_' + collapse._hexurl(url)]
+    assert first in ('alice', 'bob')
+    # the second message saw the first one's record instead of claiming it
+    messages = collapse.url([url], 'carol')
+    assert messages == []
+    assert collapse.brain['firstpost_' + collapse._hexurl(url)] == first
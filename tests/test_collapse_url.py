@@ -0,0 +1,48 @@
+import time
+
+TOOTS = ['https://mastodon.example/@a/1', 'https://mastodon.example/@b/2',
+    'https://mastodon.example/@c/3']
+
+
+def process_toot(toot_url, updates=None):
+    if toot_url == TOOTS[1]:
+        raise ValueError('mangled toot')
+    time.sleep(0.05)
+    updates['toot_' + toot_url[-1]] = ['toot ' + toot_url[-1]]
+    return ['toot ' + toot_url[-1]]
+
+
+def process_tweets(tweet_ids, via=None, updates=None):
+    updates.update(('tweet_' + i, ['tweet ' + i]) for i in tweet_ids)
+    return dict((i, ['tweet ' + i]) for i in tweet_ids)
+
+
+def test_failed_fetch_does_not_lose_the_rest(make_collapse):
+    collapse = make_collapse(process_toot=process_toot,
+        process_tweets=process_tweets)
+    urls = TOOTS[:2] + ['https://twitter.com/x/status/7'] + TOOTS[2:]
+    messages = collapse.url(urls, 'alice')
+
+    assert messages == ['toot 1', 'tweet 7', 'toot 3']
+    assert collapse.brain['toot_1'] == ['toot 1']
+    assert collapse.brain['toot_3'] == ['toot 3']
+    assert collapse.brain['tweet_7'] == ['tweet 7']
+    assert 'toot_2' not in collapse.brain
+    for url in urls:
+        hexed = collapse._hexurl(url)
+        assert collapse.brain['firstpost_' + hexed] == 'alice'
+
+
+def test_failed_tweet_lookup_keeps_the_toots(make_collapse):
+    def broken(tweet_ids, via=None, updates=None):
+        updates['tweet_7'] = ['half done']
+        raise RuntimeError('twitter fell over')
+
+    collapse = make_collapse(process_toot=process_toot,
+        process_tweets=broken)
+    messages = collapse.url(['https://twitter.com/x/status/7', TOOTS[0]],
+        'alice')
+
+    assert messages == ['toot 1']
+    assert collapse.brain['toot_1'] == ['toot 1']
+    assert 'tweet_7' not in collapse.brain
@@ -0,0 +1,69 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+from collapse.expandurl import ExpandURL
+
+SHORT = 'https://t.co/abc'
+LONG = 'https://example.com/a/long/article'
+
+
+class FakeHTTP(object):
+    """Stands in for HTTPClient. HEADs land straight away, at whatever
+    redirects says the URL goes to, or fail with whatever errors says."""
+
+    def __init__(self, redirects=None, errors=None):
+        self.redirects = redirects or {}
+        self.errors = errors or {}
+        self.submitted = []
+
+    def submit(self, method, url, **kwargs):
+        self.submitted.append(url)
+        future = Future()
+        if url in self.errors:
+            future.set_exception(self.errors[url])
+        else:
+            future.set_result(SimpleNamespace(
+                url=self.redirects.get(url, url), status_code=200))
+        return future
+
+
+@pytest.fixture
+def expanding(make_collapse):
+    def make(http):
+        collapse = make_collapse(expand_deadline=1, expand_late=0)
+        collapse.expandURL = ExpandURL(brain=collapse.brain, http=http)
+        return collapse
+    return make
+
+
+def test_each_url_is_counted_once(expanding):
+    collapse = expanding(FakeHTTP(redirects={SHORT: LONG}))
+    text = 'look ' + SHORT
+    assert collapse.expand_text_urls(text,
+        collapse.get_url_futures(text)) == 'look ' + LONG
+    stats = collapse.expandURL.cache.stats()
+    assert (stats['hits'], stats['misses']) == (0, 1)
+
+    assert collapse.expand_text_urls(text,
+        collapse.get_url_futures(text)) == 'look ' + LONG
+    stats = collapse.expandURL.cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    assert stats['ratio'] == 0.5
+
+
+def test_a_fetch_that_blows_up_is_not_left_in_flight(make_collapse):
+    http = FakeHTTP(errors={SHORT: ValueError('mangled')})
+    expander = ExpandURL(brain=make_collapse().brain, http=http)
+    expander.expand(SHORT)
+    assert expander._inflight == {}
+    expander.expand(SHORT)
+    assert http.submitted == [SHORT, SHORT]
+
+
+def test_unparseable_url_is_not_expanded(make_collapse):
+    http = FakeHTTP()
+    expander = ExpandURL(brain=make_collapse().brain, http=http)
+    assert expander.expand('http://[::1/') is False
+    assert http.submitted == []
@@ -0,0 +1,175 @@
+import http.server
+import threading
+import time
+
+import pytest
+import requests
+
+from collapse.circuitBreaker import CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from collapse.httpClient import HTTPClient
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """A local server that can be told to answer, fail with a 503, or sleep
+    before answering. It counts requests and how many were in flight at
+    once."""
+    daemon_threads = True
+
+    def __init__(self):
+        super(StandIn, self).__init__(('127.0.0.1', 0), Handler)
+        self.mode = 'ok'
+        self.delay = 0
+        self.hits = 0
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits += 1
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        try:
+            time.sleep(server.delay)
+            self.send_response(503 if server.mode == 'fail' else 200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client():
+    client = HTTPClient(failure_threshold=3, open_seconds=0.3,
+        connect_timeout=1, read_timeout=0.2)
+    yield client
+    client.close()
+
+
+def host(server):
+    return '127.0.0.1:%d' % server.server_address[1]
+
+
+def trip(client, server):
+    server.mode = 'fail'
+    for _ in range(3):
+        assert client.get(server.url).status_code == 503
+    assert client.breaker(host(server)).state == OPEN
+
+
+def test_opens_after_failure_threshold(client, server):
+    server.mode = 'fail'
+    for _ in range(2):
+        client.get(server.url)
+    assert client.breaker(host(server)).state == CLOSED
+    client.get(server.url)
+    assert client.breaker(host(server)).state == OPEN
+
+
+def test_timeouts_count_as_failures(client, server):
+    server.delay = 0.5
+    for _ in range(3):
+        with pytest.raises(requests.exceptions.Timeout):
+            client.get(server.url)
+    assert client.breaker(host(server)).state == OPEN
+
+
+def test_fails_fast_while_open(client, server):
+    trip(client, server)
+    hits = server.hits
+    began = time.time()
+    with pytest.raises(CircuitOpenError):
+        client.get(server.url)
+    assert time.time() - began < 0.05
+    assert server.hits == hits
+    assert host(server) in client.breaker_status()[0]
+
+
+def test_single_probe_after_cooldown(client, server):
+    trip(client, server)
+    time.sleep(0.35)
+    server.mode = 'ok'
+    server.delay = 0.1
+    hits = server.hits
+    probe = client.submit('GET', server.url)
+    assert client.breaker(host(server)).state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        client.get(server.url)
+    assert probe.result().status_code == 200
+    assert server.hits == hits + 1
+
+
+def test_closes_on_successful_probe(client, server):
+    trip(client, server)
+    time.sleep(0.35)
+    server.mode = 'ok'
+    breaker = client.breaker(host(server))
+    assert client.get(server.url).status_code == 200
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_reopens_on_failed_probe(client, server):
+    trip(client, server)
+    time.sleep(0.35)
+    assert client.get(server.url).status_code == 503
+    assert client.breaker(host(server)).state == OPEN
+    with pytest.raises(CircuitOpenError):
+        client.get(server.url)
+
+
+def test_per_host_limit(server):
+    client = HTTPClient(max_workers=8, per_host=2, read_timeout=2)
+    server.delay = 0.2
+    try:
+        futures = [client.submit('GET', server.url) for _ in range(6)]
+        for future in futures:
+            assert future.result().status_code == 200
+    finally:
+        client.close()
+    assert server.hits == 6
+    assert server.most_active == 2
+
+
+def test_healthy_breakers_are_forgotten(client, server):
+    client.get(server.url)
+    time.sleep(0.05)
+    assert client.breakers == {}
+    trip(client, server)
+    assert list(client.breakers) == [host(server)]
+
+
+def test_idle_breakers_pruned_past_cap(server):
+    client = HTTPClient(max_breakers=2)
+    try:
+        for name in ('a', 'b'):
+            client.breaker(name).failure()
+        client.breaker('c')
+        assert set(client.breakers) == {'c'}
+    finally:
+        client.close()
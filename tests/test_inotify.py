@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+pytest.importorskip('inotify.calls')
+
+from collapse.__main__ import CollapseBot
+
+
+@pytest.fixture
+def watching(tmp_path):
+    """A CollapseBot with nothing but its inotify watches set up, on two
+    directories under tmp_path, noting the events it'd hand off."""
+    bot = CollapseBot.__new__(CollapseBot)
+    paths = [str(tmp_path / name) for name in ('drop', 'drop_replies')]
+    for path in paths:
+        os.mkdir(path)
+    bot._watch_inotify(paths)
+    bot.seen = []
+    bot._inotify_event = lambda mask, path, filename: \
+        bot.seen.append((os.path.basename(path), filename))
+    yield bot
+    os.close(bot.inotify_fd)
+
+
+def test_drain_reads_every_ready_event(watching, tmp_path):
+    for i in range(3):
+        (tmp_path / 'drop' / ('say%d' % i)).write_text('hi')
+    staged = tmp_path / 'reply'
+    staged.write_text('')
+    os.rename(str(staged), str(tmp_path / 'drop_replies' / '12345'))
+
+    watching._drain_inotify()
+    assert watching.seen == [('drop', 'say0'), ('drop', 'say1'),
+        ('drop', 'say2'), ('drop_replies', '12345')]
+
+
+def test_drain_returns_when_nothing_is_ready(watching):
+    watching._drain_inotify()
+    assert watching.seen == []
@@ -0,0 +1,56 @@
+from collapse.journaledBrain import JournaledBrain, JOURNAL_SUFFIX
+
+
+def open_brain(tmp_path):
+    return JournaledBrain(braindir=str(tmp_path), compact_bytes=1 << 20)
+
+
+def tear(brain, key):
+    """Leave half a record at the end of key's journal, as a crash in the
+    middle of a write would"""
+    with open(brain._keyPath(key) + JOURNAL_SUFFIX, 'ab') as out:
+        out.write(b'["said_alicx", "thr')
+
+
+def test_writes_after_a_torn_record_survive_a_reopen(tmp_path):
+    brain = open_brain(tmp_path)
+    brain['said_alice'] = 'one'
+    tear(brain, 'said_alice')
+    brain['said_alicb'] = 'two'
+    brain.close()
+
+    brain = open_brain(tmp_path)
+    assert brain['said_alice'] == 'one'
+    assert brain['said_alicb'] == 'two'
+    assert 'said_alicx' not in brain
+
+
+def test_torn_tail_is_cut_off_on_replay(tmp_path):
+    brain = open_brain(tmp_path)
+    brain['said_alice'] = 'one'
+    tear(brain, 'said_alice')
+    brain.close()
+
+    brain = open_brain(tmp_path)
+    assert brain['said_alice'] == 'one'
+    with open(brain._keyPath('said_alice') + JOURNAL_SUFFIX, 'rb') as f:
+        assert f.read() == b'["said_alice", "one"]\n'
+    brain['said_alicb'] = 'two'
+    brain.close()
+
+    brain = open_brain(tmp_path)
+    assert brain['said_alicb'] == 'two'
+
+
+def test_records_after_an_old_mangled_line_are_kept(tmp_path):
+    brain = open_brain(tmp_path)
+    brain['said_alice'] = 'one'
+    brain.close()
+    # what an older version left behind: a record appended onto a torn one
+    with open(brain._keyPath('said_alice') + JOURNAL_SUFFIX, 'ab') as out:
+        out.write(b'["said_alicx", "thr["said_alicy", "lost"]\n'
+            b'["said_alicb", "two"]\n')
+
+    brain = open_brain(tmp_path)
+    assert brain['said_alice'] == 'one'
+    assert brain['said_alicb'] == 'two'
@@ -0,0 +1,35 @@
+import io
+import os
+
+from collapse.mediaCache import MediaCache
+from collapse.sqliteBrain import SqliteBrain
+
+
+def make_cache(tmp_path, max_bytes):
+    brain = SqliteBrain(braindir=str(tmp_path))
+    return MediaCache(str(tmp_path / 'media'), brain, max_bytes=max_bytes)
+
+
+def test_eviction_does_not_pull_a_file_from_under_its_reader(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=10)
+    cache.add('http://a/1', io.BytesIO(b'12345678'), '.png', 'aa')[2].close()
+    path, digest, held = cache.get('http://a/1')
+    # this add evicts the file that's being read
+    cache.add('http://a/2', io.BytesIO(b'abcdefgh'), '.png', 'bb')[2].close()
+    assert not os.path.exists(path)
+    with held:
+        assert held.read() == b'12345678'
+    assert digest == 'aa'
+
+
+def test_missing_file_is_a_miss(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=1024)
+    path, _, body = cache.add('http://a/1', io.BytesIO(b'1234'), '.png', 'aa')
+    body.close()
+    os.unlink(path)
+    assert cache.get('http://a/1') is None
+    assert cache.stats()['files'] == 0
+    assert cache.stats()['bytes'] == 0
+    # and it's written again on the next add
+    cache.add('http://a/1', io.BytesIO(b'1234'), '.png', 'aa')[2].close()
+    assert os.path.exists(path)
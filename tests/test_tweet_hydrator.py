@@ -0,0 +1,127 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import tweepy
+
+from collapse.tweetHydrator import TweetHydrator
+
+NOT_FOUND = [{'code': 144, 'message': 'No status found with that ID.'}]
+
+
+def status(tweet_id, text='hi'):
+    return SimpleNamespace(id=int(tweet_id), id_str=str(tweet_id),
+        user=SimpleNamespace(screen_name='someone'),
+        _json={'full_text': '%s %s' % (text, tweet_id)})
+
+
+class FakeAPI(object):
+    """Stands in for tweepy.API. Knows some tweets, records every call, and
+    can leave tweets out of statuses_lookup the way twitter does for ones
+    that are protected or deleted."""
+
+    def __init__(self, tweets=(), hidden=()):
+        self.tweets = dict((str(t), status(t)) for t in tweets)
+        self.hidden = set(str(t) for t in hidden)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def statuses_lookup(self, ids, **kwargs):
+        with self._lock:
+            self.calls.append(('statuses_lookup', list(ids)))
+        return [self.tweets[i] for i in ids
+            if i in self.tweets and i not in self.hidden]
+
+    def get_status(self, id, **kwargs):
+        with self._lock:
+            self.calls.append(('get_status', id))
+        if str(id) not in self.tweets:
+            raise tweepy.TweepError(NOT_FOUND)
+        return self.tweets[str(id)]
+
+
+@pytest.fixture
+def tweeting(make_collapse):
+    def make(api):
+        collapse = make_collapse(collapse_api=api,
+            ircify=lambda name, text: ['<%s> %s' % (name, text)])
+        collapse.hydrator = TweetHydrator(collapse._lookup_tweets,
+            window=0.01)
+        return collapse
+    return make
+
+
+def test_uncached_ids_share_one_lookup(tweeting):
+    api = FakeAPI(tweets=range(1, 6))
+    collapse = tweeting(api)
+    ids = [str(i) for i in range(1, 6)]
+    results = collapse.process_tweets(ids)
+    assert api.calls == [('statuses_lookup', ids)]
+    assert results['3'] == ['<someone> hi 3']
+
+
+def test_lookups_are_chunked_at_100(tweeting):
+    api = FakeAPI(tweets=range(250))
+    collapse = tweeting(api)
+    results = collapse.process_tweets([str(i) for i in range(250)])
+    assert [len(ids) for _, ids in api.calls] == [100, 100, 50]
+    assert len(results) == 250
+
+
+def test_missing_ids_fall_back_to_get_status(tweeting):
+    api = FakeAPI(tweets=[1, 2], hidden=[2])
+    collapse = tweeting(api)
+    results = collapse.process_tweets(['1', '2', '3'])
+    assert api.calls == [('statuses_lookup', ['1', '2', '3']),
+        ('get_status', '2'), ('get_status', '3')]
+    assert results['2'] == ['<someone> hi 2']
+    assert results['3'] == ['No status found with that ID.']
+
+
+def test_failed_lookup_fails_every_id(tweeting):
+    api = FakeAPI()
+
+    def broken(ids, **kwargs):
+        raise tweepy.TweepError(NOT_FOUND)
+    api.statuses_lookup = broken
+    collapse = tweeting(api)
+    results = collapse.process_tweets(['1', '2'])
+    assert results == {'1': ['No status found with that ID.'],
+        '2': ['No status found with that ID.']}
+
+
+def test_brain_hits_never_reach_the_api(tweeting):
+    api = FakeAPI(tweets=[1, 2])
+    collapse = tweeting(api)
+    collapse.process_tweets(['1', '2'])
+    api.calls = []
+    results = collapse.process_tweets(['1', '2'])
+    assert api.calls == []
+    assert results['1'] == ['<someone> hi 1']
+
+
+def test_concurrent_fetches_are_merged():
+    api = FakeAPI(tweets=range(1, 5))
+    hydrator = TweetHydrator(api.statuses_lookup, window=0.1)
+    results = {}
+
+    def fetch(ids):
+        results[tuple(ids)] = hydrator.fetch(ids)
+
+    threads = [threading.Thread(target=fetch, args=(ids,))
+        for ids in (['1', '2'], ['3'], ['4', '9'])]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+
+    assert len(api.calls) == 1
+    assert sorted(api.calls[0][1]) == ['1', '2', '3', '4', '9']
+    assert hydrator.lookups == 1
+    assert sorted(results[('1', '2')]) == ['1', '2']
+    assert list(results[('3',)]) == ['3']
+    assert results[('3',)]['3'].id == 3
+    # an id the lookup didn't return is left out
+    assert list(results[('4', '9')]) == ['4']
@@ -0,0 +1,59 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from collapse.twitterScheduler import TwitterScheduler, Throttled
+
+
+def response(remaining):
+    return SimpleNamespace(headers={'x-rate-limit-limit': '900',
+        'x-rate-limit-remaining': str(remaining),
+        'x-rate-limit-reset': str(time.time() + 600)})
+
+
+class FakeAPI(object):
+    """Stands in for tweepy.API, keeping each call's response in
+    last_response the way tweepy does. get_status hangs until it's let go,
+    so another call can land while it's in flight."""
+
+    def __init__(self):
+        self.last_response = None
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def get_status(self, id, **kwargs):
+        self.last_response = response(500)
+        self.started.set()
+        self.release.wait(1)
+        return id
+
+    def statuses_lookup(self, ids, **kwargs):
+        self.last_response = response(50)
+        return ids
+
+
+def test_headers_are_recorded_against_their_own_call():
+    api = FakeAPI()
+    scheduler = TwitterScheduler(api)
+    show = threading.Thread(target=scheduler.get_status, args=('1',))
+    show.start()
+    api.started.wait(1)
+    scheduler.statuses_lookup(['2'])
+    api.release.set()
+    show.join()
+
+    assert scheduler.families['statuses/show']['remaining'] == 500
+    assert scheduler.families['statuses/lookup']['remaining'] == 50
+
+
+def test_read_below_low_water_is_refused_at_once():
+    scheduler = TwitterScheduler(FakeAPI(), low_water=2, read_wait=2)
+    scheduler.families['statuses/lookup'] = {'limit': 900, 'remaining': 1,
+        'reset': time.time() + 600}
+    began = time.time()
+    with pytest.raises(Throttled):
+        scheduler.statuses_lookup(['1'])
+    assert time.time() - began < 0.1
+    assert scheduler.throttled == 1